@@ -2,17 +2,50 @@
 
 import argparse
 import copy
+import ctypes
+import ctypes.util
 import fcntl
+import glob
+import gzip
 import json
+import mmap
 import os
+import pty
+import re
+import select
 import shlex
 import shutil
+import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import termios
+import threading
+import time
 import traceback
-
-from typing import cast, Any, Dict, Generator, Literal, Optional, TextIO
-
+import tty
+import zlib
+
+from typing import (
+    cast,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Literal,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from collections import Counter, OrderedDict
 from contextlib import contextmanager, suppress
 from pathlib import Path
 
@@ -30,6 +63,14 @@ DEFAULT_CONF = {
     "height": 0.25,
     "width": 1.0,
     "pos": "top",
+    "class": None,
+    "evict_idle": None,
+    "evict_rss": None,
+    "prelaunch": 0,
+    "spawn_concurrency": 4,
+    "metrics": False,
+    "host_sessions": 16,
+    "host_idle": 3600,
     "shells": {
         "js": "node",
         "python": "ipython3 --no-banner",
@@ -47,39 +88,210 @@ ExecFmtMode = Literal["expanded", "string"]
 Conf = Dict[str, Any]
 
 
+class TermServer(NamedTuple):
+    """Daemon that a client-mode terminal attaches its windows to"""
+
+    cmd: str
+    # candidate socket locations, may contain placeholders and globs
+    sockets: Tuple[str, ...]
+
+
+class Term(NamedTuple):
+    executable: str
+    fmt: str
+    # new windows are served by an already running process
+    client: bool = False
+    server: Optional[TermServer] = None
+    # standalone terminal to use when the server can't be reached
+    fallback: Optional[str] = None
+    # initial size in pixels, with {width} and {height} placeholders
+    geometry: Optional[str] = None
+    classopt: Optional[str] = None
+
+
 def TERM(
     executable: str,
     execopt: str = "-e",
     execfmt: ExecFmtMode = "expanded",
     titleopt: Optional[str] = "-T",
-):
+    opts: Optional[str] = None,
+    client: bool = False,
+    server: Optional[str] = None,
+    sockets: Tuple[str, ...] = (),
+    fallback: Optional[str] = None,
+    geometryopt: Optional[str] = None,
+    classopt: Optional[str] = None,
+) -> Term:
     """Helper to declare a terminal in the hardcoded list"""
     if execfmt not in ("expanded", "string"):
         raise RuntimeError("Invalid execfmt")
 
     fmt = executable
 
+    if opts is not None:
+        fmt += " " + opts
+
+    if geometryopt is not None:
+        fmt += " {geometry}"
+
+    if classopt is not None:
+        fmt += " {wmclass}"
+
     if titleopt is not None:
         fmt += " " + titleopt + " {title}"
 
     fmt += f" {execopt} {{{execfmt}}}"
 
-    return fmt
+    term_server = None
+    if server is not None:
+        term_server = TermServer(server, sockets)
+        client = True
 
+    return Term(executable, fmt, client, term_server, fallback, geometryopt, classopt)
+
+
+FOOT_GEOMETRY = "--window-size-pixels={width}x{height}"
+KITTY_GEOMETRY = "-o initial_window_width={width} -o initial_window_height={height}"
 
 TERMS = {
-    "alacritty": TERM("alacritty", titleopt="-t"),
-    "foot": TERM("foot", titleopt="-T", execopt="", execfmt="expanded"),
+    "alacritty": TERM("alacritty", titleopt="-t", classopt="--class"),
+    "alacritty-msg": TERM(
+        "alacritty",
+        opts="msg create-window",
+        titleopt="-T",
+        classopt="--class",
+        server="alacritty --daemon",
+        # named after the display, Wayland first
+        sockets=(
+            "{$ALACRITTY_SOCKET}",
+            "{$XDG_RUNTIME_DIR}/Alacritty-{$WAYLAND_DISPLAY}-*.sock",
+            "{$XDG_RUNTIME_DIR}/Alacritty-{$DISPLAY}-*.sock",
+        ),
+        fallback="alacritty",
+    ),
+    "foot": TERM(
+        "foot",
+        titleopt="-T",
+        execopt="",
+        execfmt="expanded",
+        geometryopt=FOOT_GEOMETRY,
+        classopt="--app-id",
+    ),
+    "footclient": TERM(
+        "footclient",
+        titleopt="-T",
+        execopt="",
+        geometryopt=FOOT_GEOMETRY,
+        classopt="--app-id",
+        server="foot --server",
+        sockets=(
+            "{$XDG_RUNTIME_DIR}/foot-{$WAYLAND_DISPLAY}.sock",
+            "{$XDG_RUNTIME_DIR}/foot.sock",
+        ),
+        fallback="foot",
+    ),
     "gnome-terminal": TERM("gnome-terminal", execopt="--", titleopt=None),
-    "kitty": TERM("kitty", titleopt="-T"),
+    "kitty": TERM(
+        "kitty", titleopt="-T", geometryopt=KITTY_GEOMETRY, classopt="--class"
+    ),
+    "kitty-single": TERM(
+        "kitty",
+        opts="-1 --instance-group i3-quickterm",
+        titleopt="-T",
+        client=True,
+        geometryopt=KITTY_GEOMETRY,
+        classopt="--class",
+    ),
     "roxterm": TERM("roxterm"),
-    "st": TERM("st"),
+    "st": TERM("st", classopt="-c"),
     "terminator": TERM("terminator", execopt="-x", titleopt="-T"),
     "termite": TERM("termite", execfmt="string", titleopt="-t"),
     "urxvt": TERM("urxvt"),
-    "urxvtc": TERM("urxvtc"),
+    "urxvtc": TERM(
+        "urxvtc",
+        server="urxvtd -q -o -f",
+        sockets=("{$RXVT_SOCKET}", "{$HOME}/.urxvt/urxvtd-{hostname}"),
+        fallback="urxvt",
+    ),
+    "wezterm": TERM(
+        "wezterm",
+        opts="start",
+        execopt="--",
+        titleopt=None,
+        client=True,
+        classopt="--class",
+    ),
     "xfce4-terminal": TERM("xfce4-terminal", execfmt="string"),
-    "xterm": TERM("xterm"),
+    "xterm": TERM("xterm", classopt="-class"),
+}
+
+# how long to wait for a terminal server to come up, in seconds
+TERM_SERVER_TIMEOUT = 2.0
+# how long to use the fallback after a server failed to start, in seconds
+TERM_SERVER_RETRY = 600.0
+
+# session holders keeping shells alive when their terminal is closed,
+# the shell command is appended to the holder command
+SESSIONS = {
+    "abduco": "abduco -A {name}",
+    "dtach": "dtach -A {socket} -r winch",
+    "tmux": "tmux -L i3-quickterm new-session -A -s {name}",
+}
+
+# commands typing their standard input in the shell of a session holder
+SESSIONS_SEND = {
+    "dtach": "dtach -p {socket}",
+    "tmux": (
+        "tmux -L i3-quickterm load-buffer -b {name} - ; "
+        "paste-buffer -d -b {name} -t {name}"
+    ),
+}
+
+# how long to wait for a new quickterm to accept commands, in seconds
+SEND_TIMEOUT = 10.0
+
+SCRATCHPAD_WS = "__i3_scratch"
+
+# a pre-launched terminal not showing up after this delay is launched again
+PRELAUNCH_TIMEOUT = 10.0
+
+SPAWN_TIMEOUT = 30.0
+
+# how long a hidden quickterm looks for its own window, in seconds
+OWN_WINDOW_TIMEOUT = 2.0
+
+# on toggles of a cached quickterm, look for quickterms to evict at most this
+# often, in seconds
+EVICT_INTERVAL = 60.0
+
+# requests not accepted by the host service in time are run locally
+HOST_TIMEOUT = 2.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_HELP = {
+    "i3_quickterm_toggles_total": ("counter", "Toggle requests per shell"),
+    "i3_quickterm_request_seconds": (
+        "histogram",
+        "Duration of the requests per path (hide, show, move, create)",
+    ),
+    "i3_quickterm_menu_seconds": ("histogram", "Time waiting for the shell menu"),
+    "i3_quickterm_spawn_seconds": (
+        "histogram",
+        "Time for the windows of --spawn to appear, per shell",
+    ),
+    "i3_quickterm_history_lock_contended_total": (
+        "counter",
+        "History file accesses which had to wait for the lock",
+    ),
+    "i3_quickterm_history_lock_wait_seconds": (
+        "histogram",
+        "Time waiting for the history file lock",
+    ),
+    "i3_quickterm_con_misses_total": (
+        "counter",
+        "Requests for a shell without quickterm, which created one",
+    ),
 }
 
 
@@ -87,18 +299,242 @@ def quoted(s: str) -> str:
     return "'" + s + "'"
 
 
-def expand_command(cmd: str, **rplc_map):
-    d = {"$" + k: v for k, v in os.environ.items()}
+def expand_command(cmd: str, env: Optional[Mapping[str, str]] = None, **rplc_map):
+    d = {"$" + k: v for k, v in (env or os.environ).items()}
     d.update(rplc_map)
 
     return shlex.split(cmd.format(**d))
 
 
+def expand_path(
+    path: str, env: Optional[Mapping[str, str]] = None, **rplc_map
+) -> Optional[str]:
+    """Expand placeholders in a path, None if an environment variable is unset"""
+    d = {"$" + k: v for k, v in (env or os.environ).items()}
+    d.update(rplc_map)
+
+    try:
+        return path.format(**d)
+    except KeyError:
+        return None
+
+
+def spawn_detached(
+    cmd: List[str], env: Optional[Mapping[str, str]] = None
+) -> subprocess.Popen:
+    """Start a process in its own session, reaped in the background
+
+    No fork() of the current process: it may be running threads.
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        start_new_session=True,
+    )
+    threading.Thread(target=proc.wait, daemon=True).start()
+    return proc
+
+
+def runtime_dir() -> Path:
+    """Directory for state that does not survive the user session
+
+    Raise RuntimeError if it is not private to the user: it holds sockets
+    and FIFOs driving the shells.
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base is not None:
+        p = Path(base) / "i3-quickterm"
+    else:
+        p = Path(f"/tmp/i3-quickterm-{os.getuid()}")
+
+    os.makedirs(str(p), mode=0o700, exist_ok=True)
+    # it may have been created by someone else (in /tmp)
+    st = os.lstat(str(p))
+    if (
+        not stat.S_ISDIR(st.st_mode)
+        or st.st_uid != os.getuid()
+        or stat.S_IMODE(st.st_mode) != 0o700
+    ):
+        raise RuntimeError(f"{p} is not a private directory of the user")
+    return p
+
+
+@contextmanager
+def open_state(name: str) -> Generator[Dict[str, Any], None, None]:
+    """Locked read-modify-write access to a runtime state file"""
+    p = runtime_dir() / f"{name}.json"
+
+    f = open(str(p), "a+")
+    fcntl.lockf(f, fcntl.LOCK_EX)
+
+    try:
+        f.seek(0)
+        state: Dict[str, Any] = {}
+        with suppress(Exception):
+            state = json.load(f)
+        yield state
+        f.truncate(0)
+        json.dump(state, f)
+    finally:
+        fcntl.lockf(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def metric_series(name: str, **labels: str) -> str:
+    if len(labels) == 0:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class StatsFile:
+    """Fixed-size table of named values shared by short-lived processes
+
+    Slots are found by open addressing on a stable hash of the series name.
+    Series with names longer than KEY_SIZE bytes are not kept.
+    """
+
+    SLOTS = 1024
+    KEY_SIZE = 120
+    SLOT = struct.Struct(f"={KEY_SIZE}sd")
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @contextmanager
+    def _mapped(self) -> Generator[mmap.mmap, None, None]:
+        size = self.SLOTS * self.SLOT.size
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            with mmap.mmap(fd, size) as m:
+                yield m
+        finally:
+            os.close(fd)
+
+    def _slot(self, m: mmap.mmap, key: bytes) -> Optional[int]:
+        h = zlib.crc32(key)
+        for k in range(self.SLOTS):
+            off = ((h + k) % self.SLOTS) * self.SLOT.size
+            skey, _ = self.SLOT.unpack_from(m, off)
+            skey = skey.rstrip(b"\0")
+            if skey in (key, b""):
+                return off
+        return None
+
+    def add(self, values: Mapping[str, float]):
+        with self._mapped() as m:
+            for name, value in values.items():
+                key = name.encode()
+                if len(key) > self.KEY_SIZE:
+                    # truncated, it would not be a valid series anymore
+                    continue
+                off = self._slot(m, key)
+                if off is None:
+                    # full table
+                    return
+                _, current = self.SLOT.unpack_from(m, off)
+                self.SLOT.pack_into(m, off, key, current + value)
+
+    def read(self) -> Dict[str, float]:
+        values = {}
+        with self._mapped() as m:
+            for k in range(self.SLOTS):
+                key, value = self.SLOT.unpack_from(m, k * self.SLOT.size)
+                key = key.rstrip(b"\0")
+                if key != b"":
+                    values[key.decode()] = value
+        return values
+
+
+class Metrics:
+    """Counters and histograms, accumulated in memory until flushed"""
+
+    def __init__(self) -> None:
+        self.values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, key: str, value: float):
+        self.values[key] = self.values.get(key, 0.0) + value
+
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        with self._lock:
+            self._add(metric_series(name, **labels), value)
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        with self._lock:
+            for le in (*LATENCY_BUCKETS, float("inf")):
+                bucket_labels = dict(labels, le=f"{le:g}".replace("inf", "+Inf"))
+                self._add(
+                    metric_series(name + "_bucket", **bucket_labels),
+                    1 if seconds <= le else 0,
+                )
+            self._add(metric_series(name + "_sum", **labels), seconds)
+            self._add(metric_series(name + "_count", **labels), 1)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.values)
+
+    def flush(self, path: Path):
+        with self._lock:
+            values, self.values = self.values, {}
+        if len(values) > 0:
+            StatsFile(path).add(values)
+
+
+METRICS = Metrics()
+
+
+def render_metrics(values: Mapping[str, float]) -> str:
+    """Format values in the Prometheus text format"""
+
+    def sort_key(series: str):
+        # numerical order for histogram buckets
+        name, _, labels = series.partition("{")
+        le = float("inf")
+        for label in labels.rstrip("}").split(","):
+            if label.startswith("le="):
+                le = float(label[4:-1])
+        return name, le, labels
+
+    lines = []
+    for name, (kind, text) in sorted(METRICS_HELP.items()):
+        names: Tuple[str, ...] = (name,)
+        if kind == "histogram":
+            names = (name + "_bucket", name + "_sum", name + "_count")
+        series = [s for s in values if s.partition("{")[0] in names]
+        if len(series) == 0:
+            continue
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for s in sorted(series, key=sort_key):
+            lines.append(f"{s} {values[s]:g}")
+
+    return "".join(line + "\n" for line in lines)
+
+
+def metrics_path(conf: Conf) -> Optional[Path]:
+    if not conf["metrics"]:
+        return None
+    return runtime_dir() / "metrics"
+
+
+def flush_metrics(conf: Conf):
+    path = metrics_path(conf)
+    if path is not None:
+        METRICS.flush(path)
+
+
 def term_title(shell: str) -> str:
     return f"{shell} - i3-quickterm"
 
 
-def conf_path() -> Optional[str]:
+def conf_locations() -> List[str]:
     locations = [
         "i3-quickterm/config.json",
         "i3/i3-quickterm.json",  # legacy location
@@ -106,8 +542,11 @@ def conf_path() -> Optional[str]:
     home_dir = os.environ["HOME"]
     xdg_dir = os.environ.get("XDG_CONFIG_DIR", f"{home_dir}/.config")
 
-    for loc in locations:
-        full_loc = f"{xdg_dir}/{loc}"
+    return [f"{xdg_dir}/{loc}" for loc in locations]
+
+
+def conf_path() -> Optional[str]:
+    for full_loc in conf_locations():
         if os.path.exists(full_loc):
             return full_loc
 
@@ -127,6 +566,27 @@ def read_conf(fn) -> Conf:
         return {}
 
 
+def validate_conf(conf: Conf):
+    """Raise ValueError if the configuration can't be used"""
+    for key in ("menu", "term"):
+        if not isinstance(conf[key], str):
+            raise ValueError(f"{key} should be a string")
+    if conf["history"] is not None and not isinstance(conf["history"], str):
+        raise ValueError("history should be a string or null")
+    for key in ("width", "height"):
+        if not isinstance(conf[key], (int, float)) or not 0 < conf[key] <= 1:
+            raise ValueError(f"{key} should be a number in ]0, 1]")
+    if conf["pos"] not in ("top", "bottom"):
+        raise ValueError("pos should be 'top' or 'bottom'")
+    if not isinstance(conf["shells"], dict) or len(conf["shells"]) == 0:
+        raise ValueError("shells should be a non-empty object")
+    for name, sconf in conf["shells"].items():
+        if not isinstance(sconf, str) and not (
+            isinstance(sconf, dict) and isinstance(sconf.get("cmd"), str)
+        ):
+            raise ValueError(f"shell {name} should be a command or have a 'cmd'")
+
+
 @contextmanager
 def read_history_file(conf: Conf) -> Generator[Optional[TextIO], None, None]:
     if conf["history"] is None:
@@ -138,7 +598,15 @@ def read_history_file(conf: Conf) -> Generator[Optional[TextIO], None, None]:
     os.makedirs(str(p.parent), exist_ok=True)
 
     f = open(str(p), "a+")
-    fcntl.lockf(f, fcntl.LOCK_EX)
+    try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        METRICS.inc("i3_quickterm_history_lock_contended_total")
+        start = time.monotonic()
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        METRICS.observe(
+            "i3_quickterm_history_lock_wait_seconds", time.monotonic() - start
+        )
 
     try:
         f.seek(0)
@@ -148,11 +616,18 @@ def read_history_file(conf: Conf) -> Generator[Optional[TextIO], None, None]:
         f.close()
 
 
-def select_terminal(term_fmt: str) -> str:
+def select_terminal(term_fmt: str) -> Term:
     if term_fmt == "auto":
-        for t, fmt in sorted(TERMS.items()):
-            if shutil.which(t) is not None:
-                return fmt
+        # prefer terminals that serve new windows from a running process
+        for _, term in sorted(TERMS.items(), key=lambda t: (not t[1].client, t[0])):
+            if shutil.which(term.executable) is None:
+                continue
+            if term.server is not None and (
+                shutil.which(shlex.split(term.server.cmd)[0]) is None
+                or server_failed(term.server)
+            ):
+                continue
+            return term
         raise RuntimeError(
             f"Could not find a suitable terminal "
             f"in the predefined list: {sorted(TERMS.keys())}"
@@ -160,64 +635,574 @@ def select_terminal(term_fmt: str) -> str:
 
     if term_fmt in TERMS:
         # one of the pre-configured terminals
-        return cast(str, TERMS.get(term_fmt))
+        return TERMS[term_fmt]
+
+    return Term(term_fmt.split(" ", 1)[0], term_fmt)
+
+
+def server_running(server: TermServer, env: Optional[Mapping[str, str]] = None) -> bool:
+    """Check if one of the server sockets accepts connections"""
+    for pattern in server.sockets:
+        path = expand_path(pattern, env, hostname=socket.gethostname())
+        if path is None:
+            continue
+
+        for sock_path in glob.glob(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(sock_path)
+                except OSError:
+                    # stale socket
+                    continue
+                return True
+
+    return False
+
+
+def server_failed(server: TermServer) -> bool:
+    """The server failed to start recently"""
+    with open_state("terminal") as state:
+        failed = state.get("failed", {}).get(server.cmd, 0.0)
+    return time.time() - failed < TERM_SERVER_RETRY
+
+
+def start_server(server: TermServer, env: Optional[Mapping[str, str]] = None) -> bool:
+    """Start the terminal server and wait for it to accept connections"""
+    try:
+        proc = spawn_detached(expand_command(server.cmd, env), env)
+    except OSError:
+        return False
+
+    deadline = time.monotonic() + TERM_SERVER_TIMEOUT
+    while time.monotonic() < deadline:
+        if server_running(server, env):
+            return True
+        # servers which daemonize exit with 0
+        code = proc.poll()
+        if code is not None and code != 0:
+            return False
+        time.sleep(0.01)
+    return False
+
+
+def resolve_terminal(term: Term, env: Optional[Mapping[str, str]] = None) -> Term:
+    """Start the terminal server if needed
+
+    Falls back to the standalone terminal if the server can't be reached. A
+    failed start is remembered for TERM_SERVER_RETRY seconds, in which the
+    fallback is used directly.
+    """
+    if term.server is None or server_running(term.server, env):
+        return term
+
+    if not server_failed(term.server):
+        if start_server(term.server, env):
+            return term
+        with open_state("terminal") as state:
+            state.setdefault("failed", {})[term.server.cmd] = time.time()
+
+    if term.fallback is None:
+        raise RuntimeError(f"Could not start terminal server: {term.server.cmd}")
+
+    print(
+        f"terminal server did not start, falling back to {term.fallback}",
+        file=sys.stderr,
+    )
+    return TERMS[term.fallback]
+
+
+def shells_order(conf: Conf, hist: Optional[TextIO]) -> List[str]:
+    """Configured shells, most recently used first when history is enabled"""
+    hist_list = None
+    if hist is not None:
+        with suppress(Exception):
+            hist_list = json.load(hist)
+
+            # invalidate if different set from the configured shells
+            if set(hist_list) != set(conf["shells"].keys()):
+                hist_list = None
+
+    return hist_list or sorted(conf["shells"].keys())
+
+
+def history_order(conf: Conf) -> List[str]:
+    """Configured shells, most recently used first"""
+    if conf.get("_history") is not None:
+        # kept up to date in resident modes
+        return conf["_history"]
+
+    with read_history_file(conf) as hist:
+        return shells_order(conf, hist)
 
-    return term_fmt
+
+def write_history(hist: TextIO, shells: List[str], shell: str):
+    # put the selected shell on top
+    shells = [shell] + [s for s in shells if s != shell]
+    hist.truncate(0)
+    json.dump(shells, hist)
+
+
+def run_menu(conf: Conf, shells: List[str]) -> Optional[str]:
+    env = conf.get("_env")
+    proc = subprocess.Popen(
+        expand_command(conf["menu"], env),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+
+    assert proc.stdin is not None
+
+    start = time.monotonic()
+    for r in shells:
+        proc.stdin.write((r + "\n").encode())
+    stdout, _ = proc.communicate()
+    METRICS.observe("i3_quickterm_menu_seconds", time.monotonic() - start)
+
+    shell = stdout.decode().strip()
+
+    if len(shell) == 0:
+        return None
+
+    if shell not in conf["shells"]:
+        raise RuntimeError(f"Unknown shell: {shell}")
+
+    return shell
 
 
 def select_shell(conf: Conf) -> Optional[str]:
     """Select shell to use using menu application"""
+    history = conf.get("_history")
+    if history is not None:
+        # only written back once a shell is selected
+        shell = run_menu(conf, history)
+        if shell is not None:
+            with read_history_file(conf) as hist:
+                if hist is not None:
+                    write_history(hist, history, shell)
+        return shell
+
     with read_history_file(conf) as hist:
-        # compute the list from conf + (maybe) history
-        hist_list = None
-        if hist is not None:
-            with suppress(Exception):
-                hist_list = json.load(hist)
+        shells = shells_order(conf, hist)
 
-                # invalidate if different set from the configured shells
-                if set(hist_list) != set(conf["shells"].keys()):
-                    hist_list = None
+        shell = run_menu(conf, shells)
 
-        shells = hist_list or sorted(conf["shells"].keys())
+        if shell is not None and hist is not None:
+            write_history(hist, shells, shell)
 
-        proc = subprocess.Popen(
-            expand_command(conf["menu"]), stdin=subprocess.PIPE, stdout=subprocess.PIPE
-        )
+        return shell
+
+
+class Inotify:
+    """Minimal binding of the Linux inotify API"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, path.encode(), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"can't watch {path}")
+        return wd
+
+    def read(self) -> List[str]:
+        """Names of the files concerned by pending events"""
+        names = []
+        with suppress(BlockingIOError):
+            while True:
+                data = os.read(self.fd, 4096)
+                off = 0
+                while off < len(data):
+                    _, _, _, length = self.EVENT.unpack_from(data, off)
+                    off += self.EVENT.size
+                    names.append(data[off : off + length].rstrip(b"\0").decode())
+                    off += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """Wait for files to change, with inotify or by polling their status"""
+
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, paths: List[Path]):
+        self.paths = paths
+        self._stamps = {p: self._stamp(p) for p in paths}
+        self._inotify: Optional[Inotify] = None
+
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError, TypeError):
+            # no inotify: poll
+            return
 
-        assert proc.stdin is not None
+        # no IN_CREATE: new files are read once written and closed
+        mask = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_DELETE
+        try:
+            for d in {str(p.parent) for p in paths}:
+                inotify.add_watch(d, mask)
+        except OSError:
+            # missing directory
+            inotify.close()
+            return
+        self._inotify = inotify
 
-        for r in shells:
-            proc.stdin.write((r + "\n").encode())
-        stdout, _ = proc.communicate()
+    @staticmethod
+    def _stamp(p: Path) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = p.stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
 
-        shell = stdout.decode().strip()
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
 
-        if len(shell) == 0:
+    def wait(self, timeout: Optional[float] = None) -> Set[Path]:
+        """Return the files changed since the last call, waiting for one
+
+        An empty set is returned after `timeout` seconds without changes.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return set()
+
+            if self._inotify is not None:
+                readable, _, _ = select.select([self._inotify.fd], [], [], remaining)
+                if len(readable) == 0:
+                    continue
+                # directories are watched: keep events about our files
+                names = set(self._inotify.read())
+                changed = {p for p in self.paths if p.name in names}
+            else:
+                interval = self.POLL_INTERVAL
+                time.sleep(interval if remaining is None else min(interval, remaining))
+                changed = set()
+                for p in self.paths:
+                    stamp = self._stamp(p)
+                    if stamp != self._stamps[p]:
+                        self._stamps[p] = stamp
+                        changed.add(p)
+
+            if len(changed) > 0:
+                return changed
+
+
+class ConfWatcher:
+    """Configuration and history of long-running modes, reloaded on change
+
+    New values are parsed and validated in a background thread before being
+    handed to `on_reload`: requests never wait on file I/O, nor see a partly
+    written configuration.
+    """
+
+    def __init__(
+        self,
+        config: Optional[str],
+        on_reload: Callable[[Conf, Optional[List[str]]], None],
+    ):
+        self.config = config
+        self.on_reload = on_reload
+
+    def load(self) -> Conf:
+        """Read and validate the configuration, raise on errors"""
+        conf = copy.deepcopy(DEFAULT_CONF)
+        fn = self.config or conf_path()
+        if fn is not None:
+            with open(fn, "r") as f:
+                conf.update(json.load(f))
+        if self.config is not None:
+            conf["_config"] = self.config
+        validate_conf(conf)
+        return conf
+
+    def history(self, conf: Conf) -> Optional[List[str]]:
+        if conf["history"] is None:
             return None
+        # read-only: opening for writing would wake the watcher up again
+        try:
+            with open(expand_command(conf["history"])[0], "r") as f:
+                fcntl.lockf(f, fcntl.LOCK_SH)
+                return shells_order(conf, f)
+        except FileNotFoundError:
+            return shells_order(conf, None)
+
+    def conf_paths(self) -> List[Path]:
+        return [Path(p) for p in ([self.config] if self.config else conf_locations())]
+
+    def paths(self, conf: Conf) -> List[Path]:
+        paths = self.conf_paths()
+        if conf["history"] is not None:
+            paths.append(Path(expand_command(conf["history"])[0]))
+        return paths
+
+    def run(self, conf: Conf):
+        """Watch the files, forever"""
+        while True:
+            watcher = FileWatcher(self.paths(conf))
+            try:
+                while True:
+                    changed = watcher.wait()
+                    if not changed.isdisjoint(self.conf_paths()):
+                        try:
+                            new_conf = self.load()
+                        except Exception as e:
+                            print(f"invalid config file: {e}", file=sys.stderr)
+                            continue
+                        watched = self.paths(new_conf) != self.paths(conf)
+                        conf = new_conf
+                    else:
+                        watched = False
+
+                    self.on_reload(conf, self.history(conf))
+
+                    if watched:
+                        # the history moved
+                        break
+            finally:
+                watcher.close()
+
+    def start(self, conf: Conf):
+        threading.Thread(target=self.run, args=(conf,), daemon=True).start()
+
+
+def shell_conf(conf: Conf, shell: str) -> Dict[str, Any]:
+    """Shell options, shells can be declared with a command only"""
+    sconf = conf["shells"][shell]
+    if isinstance(sconf, str):
+        return {"cmd": sconf}
+    return sconf
+
+
+def session_name(shell: str, key: str) -> str:
+    """Name of what holds a shell of the WM instance `key` (see wm_key())"""
+    return f"{MARK_QT.format(shell)}-{key}"
+
+
+def session_command(
+    conf: Conf, shell: str, key: str, table: Mapping[str, str] = SESSIONS
+) -> Optional[List[str]]:
+    """Command to attach to (or create) the session holding the shell"""
+    session = shell_conf(conf, shell).get("session")
+    if session is None:
+        return None
 
-        if shell not in conf["shells"]:
-            raise RuntimeError(f"Unknown shell: {shell}")
+    if table is not SESSIONS and session not in table:
+        return None
 
-        if hist is not None:
-            # put the selected shell on top
-            shells = [shell] + [s for s in shells if s != shell]
-            hist.truncate(0)
-            json.dump(shells, hist)
+    name = session_name(shell, key)
+    return expand_command(
+        table.get(session, session),
+        name=name,
+        socket=str(runtime_dir() / f"{name}.session"),
+    )
 
-        return shell
 
+def control_fifo(shell: str, key: str) -> Path:
+    return runtime_dir() / f"{session_name(shell, key)}.fifo"
 
-def move_to_scratchpad(conn: i3ipc.Connection, con: i3ipc.Con):
+
+def relay_pty(cmd: List[str], fifo: Path) -> int:
+    """Run a command in a pseudo-terminal, with input from a FIFO too
+
+    Returns the exit status of the command.
+    """
+    with suppress(FileNotFoundError):
+        os.unlink(str(fifo))
+    os.mkfifo(str(fifo), 0o600)
+    # read-write: no EOF when writers come and go
+    fifo_fd = os.open(str(fifo), os.O_RDWR | os.O_NONBLOCK)
+
+    pid, master = pty.fork()
+    if pid == 0:
+        os.execvp(cmd[0], cmd)
+
+    stdin = pty.STDIN_FILENO
+    stdout = pty.STDOUT_FILENO
+    is_tty = os.isatty(stdin)
+
+    def resize(*_):
+        winsize = fcntl.ioctl(stdin, termios.TIOCGWINSZ, b"\0" * 8)
+        fcntl.ioctl(master, termios.TIOCSWINSZ, winsize)
+
+    attrs = None
+    if is_tty:
+        attrs = termios.tcgetattr(stdin)
+        tty.setraw(stdin)
+        resize()
+        signal.signal(signal.SIGWINCH, resize)
+
+    inputs = [master, stdin, fifo_fd]
+    try:
+        while True:
+            try:
+                readable, _, _ = select.select(inputs, [], [])
+            except InterruptedError:
+                continue
+
+            if master in readable:
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    data = b""
+                if len(data) == 0:
+                    # the command exited
+                    break
+                os.write(stdout, data)
+
+            for fd in (stdin, fifo_fd):
+                if fd in readable:
+                    data = os.read(fd, 4096)
+                    if len(data) == 0:
+                        inputs.remove(fd)
+                    else:
+                        os.write(master, data)
+    finally:
+        if attrs is not None:
+            termios.tcsetattr(stdin, termios.TCSAFLUSH, attrs)
+        os.close(fifo_fd)
+        with suppress(FileNotFoundError):
+            os.unlink(str(fifo))
+        os.close(master)
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def shell_from_marks(marks: Sequence[str]) -> Optional[str]:
+    prefix = MARK_QT.format("")
+    for m in marks:
+        if m.startswith(prefix):
+            return m[len(prefix) :]
+    return None
+
+
+def process_rss(pid: int) -> int:
+    """Resident memory of a process in bytes, 0 if unknown"""
+    with suppress(OSError, ValueError), open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class Rect(NamedTuple):
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class WorkspaceRef:
+    """What quickterm needs to know of a workspace
+
+    Unlike i3ipc.Con, it holds no reference to the rest of the tree.
+    """
+
+    __slots__ = ("name", "output", "rect")
+
+    def __init__(self, name: str, output: Optional[str], rect: Rect):
+        self.name = name
+        self.output = output
+        self.rect = rect
+
+    @classmethod
+    def from_con(cls, ws: i3ipc.Con) -> "WorkspaceRef":
+        output = ws.ipc_data.get("output")
+        if output is None:
+            # i3: in the content container of the output
+            node = ws.parent
+            while node is not None and node.type != "output":
+                node = node.parent
+            output = node.name if node is not None else None
+        r = ws.rect
+        return cls(ws.name, output, Rect(r.x, r.y, r.width, r.height))
+
+    @classmethod
+    def from_reply(cls, ws: i3ipc.WorkspaceReply) -> "WorkspaceRef":
+        r = ws.rect
+        return cls(ws.name, ws.output, Rect(r.x, r.y, r.width, r.height))
+
+
+class ConRef:
+    """What quickterm needs to know of a container, see WorkspaceRef"""
+
+    __slots__ = ("id", "marks", "workspace")
+
+    def __init__(self, con_id: int, marks: Tuple[str, ...], workspace: Optional[str]):
+        self.id = con_id
+        self.marks = marks
+        self.workspace = workspace
+
+    @classmethod
+    def from_con(cls, con: i3ipc.Con) -> "ConRef":
+        ws = con.workspace()
+        return cls(con.id, tuple(con.marks), ws.name if ws is not None else None)
+
+
+def move_to_scratchpad(conn: i3ipc.Connection, con: ConRef):
     conn.command(f"[con_id={con.id}] floating enable, move scratchpad")
 
 
-def get_current_workspace(conn: i3ipc.Connection):
+def get_current_workspace(conn: i3ipc.Connection) -> Optional[i3ipc.Con]:
     focused = conn.get_tree().find_focused()
     if not focused:
         return None
     return focused.workspace()
 
 
+def wm_key(conn: i3ipc.Connection) -> str:
+    """Identifier of the WM instance, for the state kept about it"""
+    return f"{zlib.crc32(str(conn.socket_path).encode()):08x}"
+
+
+class Capabilities(NamedTuple):
+    """What the WM supports, to pick the cheapest commands"""
+
+    # floating windows can be sized and placed in % of their workspace
+    ppt_geometry: bool
+    # commands whose criteria match nothing fail (i3 reports success)
+    reports_unmatched: bool
+
+    @classmethod
+    def from_version(cls, version: Dict[str, Any]) -> "Capabilities":
+        sway = version.get("variant") == "sway"
+        return cls(ppt_geometry=sway, reports_unmatched=sway)
+
+
+CAPABILITIES: Dict[str, Capabilities] = {}
+
+
+def wm_capabilities(conn: i3ipc.Connection) -> Capabilities:
+    """Capabilities of the WM, queried once per instance"""
+    key = wm_key(conn)
+    caps = CAPABILITIES.get(key)
+    if caps is None:
+        with open_state(f"wm-{key}") as state:
+            if "version" not in state:
+                state["version"] = conn.get_version().ipc_data
+            caps = Capabilities.from_version(state["version"])
+        CAPABILITIES[key] = caps
+    return caps
+
+
 class VerboseConnection(i3ipc.Connection):
     def __init__(self):
         super().__init__()
@@ -227,31 +1212,151 @@ class VerboseConnection(i3ipc.Connection):
         return super().command(payload, *kargs, **kwargs)
 
 
+class RecordingConnection(i3ipc.Connection):
+    """Connection saving the messages exchanged with the WM, see --record
+
+    Each message is appended to the file as a JSON line with its type,
+    payload, reply and duration; processes of the same request (such as the
+    quickterm started in a new terminal) add to the same recording.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._write({"argv": sys.argv[1:]})
+
+    def _write(self, entry: Dict[str, Any]):
+        with open(self.path, "a") as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write(json.dumps(entry) + "\n")
+
+    def _message(self, message_type, payload):
+        start = time.monotonic()
+        reply = super()._message(message_type, payload)
+        self._write(
+            {
+                "type": message_type.value,
+                "payload": payload,
+                "reply": reply,
+                "seconds": round(time.monotonic() - start, 6),
+            }
+        )
+        return reply
+
+
+def read_recording(path: str) -> List[Dict[str, Any]]:
+    """Messages of a recording (possibly gzipped)"""
+    if path.endswith(".gz"):
+        f = cast(TextIO, gzip.open(path, "rt"))
+    else:
+        f = open(path, "r")
+    with f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return [e for e in entries if "type" in e]
+
+
+IPC_HEADER = struct.Struct("=6sII")
+IPC_MAGIC = b"i3-ipc"
+IPC_COMMAND = 0
+
+
+class ReplayServer:
+    """Fake WM answering IPC requests from a recording, see --replay
+
+    Each request gets the reply of the first recorded message of the same
+    type and payload not replayed yet. Requests missing from the recording
+    are kept in `unmatched`: queries get the last reply to the same query
+    (the state is not supposed to change), commands fail.
+    """
+
+    def __init__(self, path: str):
+        self.messages = read_recording(path)
+        self.replayed = [False] * len(self.messages)
+        self.unmatched: List[Tuple[int, str]] = []
+        self._lock = threading.Lock()
+        self._server: Optional[socket.socket] = None
+
+    def reply(self, msg_type: int, payload: str) -> str:
+        with self._lock:
+            last = None
+            for k, m in enumerate(self.messages):
+                if m["type"] != msg_type or m["payload"] != payload:
+                    continue
+                if not self.replayed[k]:
+                    self.replayed[k] = True
+                    return m["reply"]
+                last = m["reply"]
+
+            self.unmatched.append((msg_type, payload))
+            if msg_type == IPC_COMMAND:
+                return json.dumps([{"success": False, "error": "not recorded"}])
+            return last if last is not None else "{}"
+
+    @property
+    def done(self) -> bool:
+        """All the recorded messages have been replayed"""
+        return all(self.replayed)
+
+    def _serve_client(self, client: socket.socket):
+        with client, client.makefile("rb") as f:
+            while True:
+                header = f.read(IPC_HEADER.size)
+                if len(header) < IPC_HEADER.size:
+                    return
+                magic, length, msg_type = IPC_HEADER.unpack(header)
+                if magic != IPC_MAGIC:
+                    return
+                payload = f.read(length).decode()
+                reply = self.reply(msg_type, payload).encode()
+                client.sendall(IPC_HEADER.pack(IPC_MAGIC, len(reply), msg_type) + reply)
+
+    def listen(self, path: Path):
+        with suppress(FileNotFoundError):
+            os.unlink(str(path))
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(str(path))
+        self._server.listen()
+
+    def serve(self):
+        assert self._server is not None
+        with self._server:
+            while True:
+                client, _ = self._server.accept()
+                threading.Thread(
+                    target=self._serve_client, args=(client,), daemon=True
+                ).start()
+
+
 class Quickterm:
     def __init__(self, conf: Conf, shell: Optional[str]):
         self.conf = conf
         self.shell = shell
-        self._ws: Optional[i3ipc.Con] = None
+        self._ws: Optional[WorkspaceRef] = None
         self._ws_fetched = False
         self._conn: Optional[i3ipc.Connection] = None
-        self._con: Optional[i3ipc.Con] = None
+        self._con: Optional[ConRef] = None
         self._con_fetched = False
         self._verbose = self.conf.get("_verbose", False)
 
     @property
     def conn(self) -> i3ipc.Connection:
         if self._conn is None:
-            if self._verbose:
+            if "_record" in self.conf:
+                self._conn = RecordingConnection(self.conf["_record"])
+            elif self._verbose:
                 self._conn = VerboseConnection()
             else:
                 self._conn = i3ipc.Connection()
         return self._conn
 
+    def _set_ws(self, ws: Optional[i3ipc.Con]):
+        self._ws = WorkspaceRef.from_con(ws) if ws is not None else None
+        self._ws_fetched = True
+
     @property
-    def ws(self) -> Optional[i3ipc.Con]:
-        if not self._ws_fetched and self._ws is None:
-            self._ws = get_current_workspace(self.conn)
-            self._ws_fetched = True
+    def ws(self) -> Optional[WorkspaceRef]:
+        if not self._ws_fetched:
+            self._set_ws(get_current_workspace(self.conn))
         return self._ws
 
     @property
@@ -261,29 +1366,38 @@ class Quickterm:
         return MARK_QT.format(self.shell)
 
     @property
-    def con(self) -> Optional[i3ipc.Con]:
+    def con(self) -> Optional[ConRef]:
         """Find container in complete tree"""
-        if not self._con_fetched and self._con is None:
-            node = self.conn.get_tree().find_marked(self.mark)
+        if not self._con_fetched:
+            tree = self.conn.get_tree()
+            node = tree.find_marked(self.mark)
             if len(node) == 0:
                 self._con = None
             else:
-                self._con = node[0]
+                self._con = ConRef.from_con(node[0])
             self._con_fetched = True
+            if not self._ws_fetched:
+                # no need to fetch the tree again for it
+                focused = tree.find_focused()
+                self._set_ws(focused.workspace() if focused else None)
         return self._con
 
-    def con_in_workspace(self, mark: str) -> Optional[i3ipc.Con]:
+    def con_in_workspace(self, mark: str) -> Optional[ConRef]:
         """Find container in workspace"""
-        if self.ws is None:
+        ws = get_current_workspace(self.conn)
+        if not self._ws_fetched:
+            self._set_ws(ws)
+        if ws is None:
             return None
-        c = self.ws.find_marked(mark)
+        c = ws.find_marked(mark)
         if len(c) == 0:
             return None
-        return c[0]
+        return ConRef.from_con(c[0])
 
     def execvp(self, cmd):
         if self._verbose:
             print(f"execvp: {cmd}")
+        flush_metrics(self.conf)
         os.execvp(cmd[0], cmd)
 
     """Operations"""
@@ -294,31 +1408,221 @@ class Quickterm:
         Mark current window, move back and focus again, then run shell in current
         process
         """
+        assert self.shell is not None
+
+        if self.conf.get("_spawned", False):
+            # marked, hidden and cached by the spawner
+            pass
+        elif self.conf.get("_hidden", False):
+            # pre-launched: wait in the scratchpad
+            con_id = self.own_window()
+            if con_id is not None:
+                self.conn.command(
+                    f"[con_id={con_id}] mark {self.mark}, move scratchpad"
+                )
+                self.cache_con(self.shell, con_id, SCRATCHPAD_WS)
+        else:
+            # the mark goes to a new container
+            self.uncache_con(self.shell)
+            self.conn.command(f"mark {self.mark}")
+            self.focus_on_current_ws()
+        self.record_use()
 
-        self.conn.command(f"mark {self.mark}")
+        sconf = shell_conf(self.conf, self.shell)
+        prog_cmd = expand_command(sconf["cmd"])
+        key = wm_key(self.conn)
+        session_cmd = session_command(self.conf, self.shell, key)
+        if session_cmd is not None:
+            # the next terminal will reattach to the running shell
+            prog_cmd = session_cmd + prog_cmd
 
-        self.focus_on_current_ws()
+        if sconf.get("fifo", False):
+            # stay around to relay the commands sent with --send
+            flush_metrics(self.conf)
+            sys.exit(relay_pty(prog_cmd, control_fifo(self.shell, key)))
 
-        prog_cmd = expand_command(self.conf["shells"][self.shell])
         self.execvp(prog_cmd)
 
-    def toggle_on_current_ws(self):
-        """If on another workspace: hide, otherwise show on current"""
+    def own_window(self) -> Optional[int]:
+        """Container of the terminal running this process, found by title
+
+        Hidden quickterms are started in the background: the focused window is
+        not necessarily theirs.
+        """
+        assert self.shell is not None
+        title = term_title(self.shell)
+        if sys.stdout.isatty():
+            # for the terminals without a title option
+            sys.stdout.write(f"\033]2;{title}\007")
+            sys.stdout.flush()
+
+        deadline = time.monotonic() + OWN_WINDOW_TIMEOUT
+        while True:
+            cons = self.conn.get_tree().find_titled(f"^{re.escape(title)}$")
+            if len(cons) > 0:
+                # prefer the new one, if the title is not unique
+                cons.sort(key=lambda c: shell_from_marks(c.marks) is not None)
+                return cons[0].id
+            if time.monotonic() > deadline:
+                print(f"window of {self.shell} not found", file=sys.stderr)
+                return None
+            time.sleep(0.05)
+
+    def can_send(self) -> bool:
+        """The shell has a way to receive commands, see send()"""
+        assert self.shell is not None
+        if shell_conf(self.conf, self.shell).get("fifo", False):
+            return True
+        return session_command(self.conf, self.shell, "", SESSIONS_SEND) is not None
+
+    def send(self, text: str) -> bool:
+        """Type a command line in the running shell
+
+        Returns False if the shell can't receive it
+        """
+        assert self.shell is not None
+        data = text + "\r"
+        key = wm_key(self.conn)
+
+        try:
+            fd = os.open(
+                str(control_fifo(self.shell, key)), os.O_WRONLY | os.O_NONBLOCK
+            )
+        except OSError:
+            pass
+        else:
+            try:
+                os.write(fd, data.encode())
+            finally:
+                os.close(fd)
+            return True
+
+        send_cmd = session_command(self.conf, self.shell, key, SESSIONS_SEND)
+        if send_cmd is None:
+            return False
+        proc = subprocess.run(
+            send_cmd,
+            input=data.encode(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return proc.returncode == 0
+
+    def toggle_on_current_ws(self) -> str:
+        """If on another workspace: hide, otherwise show on current
+
+        Returns what was done: hide, show (from the scratchpad) or move (from
+        another workspace)
+        """
         assert self.con is not None
         move_to_scratchpad(self.conn, self.con)
 
-        qt_ws = self.con.workspace()
-        if self.ws is not None and (qt_ws is None or qt_ws.name != self.ws.name):
+        action = "hide"
+        new_ws = SCRATCHPAD_WS
+        qt_ws = self.con.workspace
+        if self.ws is not None and qt_ws != self.ws.name:
             self.focus_on_current_ws()
+            action = "show"
+            if qt_ws is not None and qt_ws != SCRATCHPAD_WS:
+                action = "move"
+            new_ws = self.ws.name
 
-    def focus_on_current_ws(self):
-        """Focus existing qt on current workspace"""
-        ws = self.ws
-        assert ws is not None
+        assert self.shell is not None
+        self.cache_con(self.shell, self.con.id, new_ws)
+        self.record_use()
+        return action
+
+    def record_use(self):
+        """Remember when the quickterm was last toggled, for eviction"""
+        if self.conf["evict_idle"] is None and self.conf["evict_rss"] is None:
+            return
+
+        with open_state(f"usage-{wm_key(self.conn)}") as state:
+            state[self.shell] = time.time()
+
+    def evict_idle(self, interval: float = 0.0):
+        """Close hidden quickterms whose shell lives in a session holder
+
+        Least recently used ones go first: those idle for longer than
+        `evict_idle` seconds, then as many as needed to fit hidden terminals in
+        `evict_rss` MiB. They will be reattached in a new terminal on the next
+        toggle.
+
+        Nothing is done if they were checked less than `interval` seconds ago.
+        """
+        idle = self.conf["evict_idle"]
+        budget = self.conf["evict_rss"]
+        if idle is None and budget is None:
+            return
+
+        evictable = {
+            s
+            for s in self.conf["shells"]
+            if s != self.shell and shell_conf(self.conf, s).get("session")
+        }
+        if len(evictable) == 0:
+            return
+
+        key = wm_key(self.conn)
+        now = time.time()
+        with open_state(f"evicted-{key}") as state:
+            if now - state.get("checked", 0.0) < interval:
+                return
+            state["checked"] = now
+
+        with open_state(f"usage-{key}") as state:
+            last_used = dict(state)
+
+        # quickterms with unknown usage are considered fresh
+        hidden = []
+        tree = self.conn.get_tree()
+        for con in tree.find_marked(MARK_QT_PATTERN):
+            ws = con.workspace()
+            if ws is None or ws.name != SCRATCHPAD_WS:
+                continue
+            shell = shell_from_marks(con.marks)
+            if shell is not None and shell in evictable:
+                hidden.append((last_used.get(shell, now), con))
+        hidden.sort(key=lambda h: h[0])
+
+        evicted = []
+        if idle is not None:
+            evicted = [c for t, c in hidden if now - t > idle]
+        kept = [c for _, c in hidden if c not in evicted]
+
+        if budget is not None:
+            # terminals in client mode share their process with all their
+            # windows: each one only counts for its share
+            windows = Counter(c.pid for c in tree.leaves() if c.pid is not None)
+            rss = {c.pid: process_rss(c.pid) for c in kept if c.pid is not None}
+            share = {
+                c.id: rss[c.pid] / max(windows[c.pid], 1)
+                for c in kept
+                if c.pid is not None
+            }
+            total = sum(share.values())
+            while total > budget * 1024 * 1024 and len(kept) > 0:
+                c = kept.pop(0)
+                evicted.append(c)
+                total -= share.get(c.id, 0)
+
+        if len(evicted) > 0:
+            self.conn.command("; ".join(f"[con_id={c.id}] kill" for c in evicted))
+            # not to be pre-launched again until used
+            with open_state(f"evicted-{key}") as state:
+                shells = state.setdefault("shells", {})
+                for c in evicted:
+                    shells[shell_from_marks(c.marks)] = now
+
+    def target_geometry(self, rect: Optional[Rect] = None) -> Tuple[int, int, int, int]:
+        """Position and size of the quickterm on the current workspace"""
+        if rect is None:
+            assert self.ws is not None
+            rect = self.ws.rect
         pos = self.conf["pos"]
 
-        wx, wy = ws.rect.x, ws.rect.y
-        wwidth, wheight = ws.rect.width, ws.rect.height
+        wx, wy = rect.x, rect.y
+        wwidth, wheight = rect.width, rect.height
 
         height = int(wheight * self.conf["height"])
         width = int(wwidth * self.conf["width"])
@@ -330,37 +1634,196 @@ class Quickterm:
         else:  # pos == 'top'
             posy = wy
 
-        self.conn.command(
-            f"[con_mark={self.mark}] "
+        return posx, posy, width, height
+
+    def ppt_geometry(self) -> Optional[Tuple[int, int, int]]:
+        """Position and size in % of the workspace, if exact (at the top)"""
+        if self.conf["pos"] != "top" or not wm_capabilities(self.conn).ppt_geometry:
+            return None
+        width = self.conf["width"] * 100
+        height = self.conf["height"] * 100
+        if width != int(width) or height != int(height) or (100 - width) % 2 != 0:
+            return None
+        return int(100 - width) // 2, int(width), int(height)
+
+    def show_command(self, criteria: str, rect: Optional[Rect] = None) -> str:
+        ppt = self.ppt_geometry()
+        if ppt is not None:
+            # no need for the workspace size
+            posx_ppt, width_ppt, height_ppt = ppt
+            return (
+                f"[{criteria}] "
+                f"move scratchpad, "
+                f"scratchpad show, "
+                f"resize set width {width_ppt} ppt height {height_ppt} ppt, "
+                f"move position {posx_ppt} ppt 0 ppt"
+            )
+
+        posx, posy, width, height = self.target_geometry(rect)
+
+        return (
+            f"[{criteria}] "
             f"move scratchpad, "
             f"scratchpad show, "
             f"resize set {width} {height} px, "
             f"move absolute position {posx} {posy} px"
         )
 
-    def execute_term(self):
-        """Launch i3-quickterm in a new terminal"""
+    def focus_on_current_ws(self):
+        """Focus existing qt on current workspace"""
+        self.conn.command(self.show_command(f"con_mark={self.mark}"))
+
+    @property
+    def cache_name(self) -> str:
+        # container ids are only valid for one WM instance
+        return f"cons-{wm_key(self.conn)}"
+
+    def cache_con(self, shell: str, con_id: int, ws_name: str):
+        """Remember where the container of a shell is"""
+        with open_state(self.cache_name) as cache:
+            cache[shell] = {"id": con_id, "ws": ws_name}
+
+    def uncache_con(self, shell: str):
+        with open_state(self.cache_name) as cache:
+            cache.pop(shell, None)
+
+    def toggle_cached(self) -> Optional[str]:
+        """Toggle with the cached container id, without fetching the tree
+
+        Returns what was done like toggle_on_current_ws(), or None if the cache
+        can't be used (the tree has to be searched then).
+
+        The action depends on the cached workspace: every path moving the
+        quickterm updates it. If the quickterm was moved by other means, the
+        command still applies to it (shown, or hidden again) and the entry is
+        right again for the next toggle.
+        """
+        assert self.shell is not None
+
+        with open_state(self.cache_name) as cache:
+            entry = cache.pop(self.shell, None)
+            if entry is None:
+                return None
+
+            focused = [w for w in self.conn.get_workspaces() if w.focused]
+            if len(focused) == 0:
+                return None
+            # if the WM reports commands matching nothing, a closed quickterm
+            # makes them fail below (sway does not reuse container ids)
+            caps = wm_capabilities(self.conn)
+            if not caps.reports_unmatched and self.mark not in self.conn.get_marks():
+                # the quickterm has been closed
+                return None
+            ws = WorkspaceRef.from_reply(focused[0])
+
+            # the mark is checked too: i3 reuses the ids of closed containers
+            criteria = f"con_id={entry['id']} con_mark=^{self.mark}$"
+            if entry["ws"] == ws.name:
+                action = "hide"
+                cmd = f"[{criteria}] floating enable, move scratchpad"
+                new_ws = SCRATCHPAD_WS
+            else:
+                action = "show" if entry["ws"] == SCRATCHPAD_WS else "move"
+                cmd = self.show_command(criteria, ws.rect)
+                new_ws = ws.name
+
+            replies = self.conn.command(cmd)
+            if not all(r.success for r in replies):
+                # stale entry
+                return None
+            cache[self.shell] = {"id": entry["id"], "ws": new_ws}
+
+        self.record_use()
+        return action
+
+    def record_prelaunch(self, created: bool):
+        """Count requests served by a pre-launched terminal (or not)"""
+        if self.conf["prelaunch"] == 0:
+            return
+
+        if created:
+            counter = "misses"
+        else:
+            with open_state(f"prelaunch-{wm_key(self.conn)}") as pending:
+                if self.shell not in pending:
+                    return
+                del pending[self.shell]
+            counter = "hits"
+
+        # statistics of all the sessions
+        with open_state("prelaunch") as state:
+            state[counter] = state.get(counter, 0) + 1
+
+    def for_shell(self, shell: str) -> "Quickterm":
+        """Quickterm of another shell, sharing connection and workspace"""
+        qt = copy.copy(self)
+        qt.shell = shell
+        qt._con = None
+        qt._con_fetched = False
+        return qt
+
+    def terminal(self) -> Term:
+        return resolve_terminal(self.term_entry(), self.conf.get("_env"))
+
+    def term_entry(self) -> Term:
+        """Configured terminal, before its server is checked"""
+        return select_terminal(self.conf["term"])
+
+    def term_command(self, hidden: bool = False, spawned: bool = False) -> List[str]:
+        """Command of a new terminal running i3-quickterm in place"""
         assert self.shell is not None
 
-        term = select_terminal(self.conf["term"])
+        env = self.conf.get("_env")
+        term = self.terminal()
         qt_cmd = f"{sys.argv[0]} -i {self.shell}"
+        if spawned:
+            qt_cmd += " --spawned"
+        elif hidden:
+            qt_cmd += " --hidden"
         if self._verbose:
             qt_cmd += " -v"
         if "_config" in self.conf:
             qt_cmd += f" -c {self.conf['_config']}"
-
-        term_cmd = expand_command(
-            term,
+        if "_record" in self.conf:
+            qt_cmd += f" --record {self.conf['_record']}"
+
+        geometry = ""
+        if term.geometry is not None and self.ws is not None:
+            # start at the final size, not resized (and re-rendered) after
+            _, _, width, height = self.target_geometry()
+            if width > 0 and height > 0:
+                geometry = term.geometry.format(width=width, height=height)
+
+        wmclass = ""
+        if term.classopt is not None and self.conf["class"] is not None:
+            wmclass = f"{term.classopt} {quoted(self.conf['class'])}"
+
+        return expand_command(
+            term.fmt,
+            env,
+            geometry=geometry,
+            wmclass=wmclass,
             title=quoted(term_title(self.shell)),
             expanded=qt_cmd,
             string=quoted(qt_cmd),
         )
-        self.execvp(term_cmd)
+
+    def execute_term(self):
+        """Launch i3-quickterm in a new terminal"""
+        self.execvp(self.term_command())
+
+    def prelaunch_term(self):
+        """Launch i3-quickterm in a new terminal, hidden in the scratchpad"""
+        spawn_detached(self.term_command(hidden=True))
+
+        with open_state(f"prelaunch-{wm_key(self.conn)}") as pending:
+            pending[self.shell] = time.time()
 
 
 def run_qt(qt: Quickterm, in_place: bool = False):
     """Main logic"""
     shell = qt.shell
+    start = time.monotonic()
 
     if in_place:
         if shell is None:
@@ -375,6 +1838,13 @@ def run_qt(qt: Quickterm, in_place: bool = False):
         if c is not None:
             # undefined shell and visible on workspace: hide
             move_to_scratchpad(qt.conn, c)
+            hidden_shell = shell_from_marks(c.marks)
+            if hidden_shell is not None:
+                qt.cache_con(hidden_shell, c.id, SCRATCHPAD_WS)
+            METRICS.observe(
+                "i3_quickterm_request_seconds", time.monotonic() - start, path="hide"
+            )
+            qt.evict_idle()
             return
 
         # undefined shell and nothing on workspace: ask for shell selection
@@ -382,20 +1852,605 @@ def run_qt(qt: Quickterm, in_place: bool = False):
         if shell is None:
             return
         qt.shell = shell
+        # the menu is not part of the request processing time
+        start = time.monotonic()
+
+    METRICS.inc("i3_quickterm_toggles_total", shell=shell)
+
+    # fast path: the quickterm is known from a previous toggle
+    action = qt.toggle_cached()
+    if action is not None:
+        qt.record_prelaunch(created=False)
+        METRICS.observe(
+            "i3_quickterm_request_seconds", time.monotonic() - start, path=action
+        )
+        # not to lose the benefit of the fast path to a tree search each time
+        qt.evict_idle(EVICT_INTERVAL)
+        return
 
     # show logic
     # if it does not exist: create
     # else: toggle on current workspace
     if qt.con is None:
+        METRICS.inc("i3_quickterm_con_misses_total", shell=shell)
+        METRICS.observe(
+            "i3_quickterm_request_seconds", time.monotonic() - start, path="create"
+        )
+        qt.record_prelaunch(created=True)
         qt.execute_term()
         return
 
-    qt.toggle_on_current_ws()
+    qt.record_prelaunch(created=False)
+    action = qt.toggle_on_current_ws()
+    METRICS.observe(
+        "i3_quickterm_request_seconds", time.monotonic() - start, path=action
+    )
+    qt.evict_idle()
 
 
-def main(argv=None):
+def run_send(qt: Quickterm, cmd: List[str], show: bool = False) -> int:
+    """Run a command in the shell of a quickterm, started if needed
+
+    The command is typed in the terminal as soon as the relay or session holder
+    takes it: the shell reads it when it is ready, like typed-ahead input.
+    Arguments are joined as they are: quoting is up to the caller, for the
+    language of the shell.
+    """
+    if not qt.can_send():
+        print(
+            f"can't send to {qt.shell}: enable 'fifo' or use tmux or dtach sessions",
+            file=sys.stderr,
+        )
+        return 1
+    text = " ".join(cmd)
+
+    if qt.con is None:
+        spawn_detached(qt.term_command(hidden=not show))
+
+        deadline = time.monotonic() + SEND_TIMEOUT
+        while not qt.send(text):
+            if time.monotonic() > deadline:
+                print(f"{qt.shell} quickterm did not start", file=sys.stderr)
+                return 1
+            time.sleep(0.05)
+        return 0
+
+    if show:
+        qt.focus_on_current_ws()
+        # for the next toggle to hide it
+        if qt.ws is not None:
+            assert qt.shell is not None
+            qt.cache_con(qt.shell, qt.con.id, qt.ws.name)
+        qt.record_use()
+
+    if not qt.send(text):
+        print(f"{qt.shell} quickterm did not take the command", file=sys.stderr)
+        return 1
+    return 0
+
+
+def prelaunch_missing(qt: Quickterm):
+    """Pre-launch the most used shells which are not running"""
+    conf = qt.conf
+    top = history_order(conf)[: conf["prelaunch"]]
+
+    running = {
+        shell_from_marks(c.marks)
+        for c in qt.conn.get_tree().find_marked(MARK_QT_PATTERN)
+    }
+
+    key = wm_key(qt.conn)
+    with open_state(f"prelaunch-{key}") as state:
+        pending = dict(state)
+    with open_state(f"usage-{key}") as state:
+        last_used = dict(state)
+    with open_state(f"evicted-{key}") as state:
+        evicted = dict(state.get("shells", {}))
+
+    now = time.time()
+    for shell in top:
+        if shell in running:
+            continue
+        if shell in evicted and evicted[shell] >= last_used.get(shell, 0.0):
+            # closed by the eviction, and not used since
+            continue
+        if now - pending.get(shell, 0.0) < PRELAUNCH_TIMEOUT:
+            # launched, not mapped yet
+            continue
+        Quickterm(conf, shell).prelaunch_term()
+
+
+def run_prelaunch(qt: Quickterm):
+    """Keep the most used shells pre-launched until the session ends"""
+    if qt.conf["prelaunch"] == 0:
+        print("prelaunch is disabled in the configuration", file=sys.stderr)
+        return
+
+    def on_reload(conf: Conf, history: Optional[List[str]]):
+        private = {k: v for k, v in qt.conf.items() if k.startswith("_")}
+        qt.conf = {**conf, **private, "_history": history}
+
+    ConfWatcher(qt.conf.get("_config"), on_reload).start(qt.conf)
+
+    prelaunch_missing(qt)
+
+    def on_close(conn: i3ipc.Connection, e: i3ipc.events.IpcBaseEvent):
+        if shell_from_marks(cast(i3ipc.WindowEvent, e).container.marks) is not None:
+            prelaunch_missing(qt)
+
+    qt.conn.on(i3ipc.Event.WINDOW_CLOSE, on_close)
+    qt.conn.main()
+
+
+class Spawner:
+    """Start several quickterms at once, hidden in the scratchpad
+
+    Terminals are started in parallel, up to `spawn_concurrency` at a time.
+    Their windows are recognized by title when they appear and all the ones
+    which appeared in the meantime are marked and hidden with a single
+    command. Terminals which can't be given a title mark themselves.
+    """
+
+    def __init__(self, qt: Quickterm, shells: List[str]):
+        self.qt = qt
+        self.queue = list(shells)
+        self.pending: Dict[str, float] = {}
+        self.arrived: List[Tuple[str, int]] = []
+        self.times: Dict[str, float] = {}
+        self.cond = threading.Condition()
+        term = qt.terminal()
+        # recognize the windows by title when possible
+        self.titled = "{title}" in term.fmt
+        if term.geometry is not None:
+            # fetch the workspace once for all terminals
+            qt.ws  # noqa: B018
+
+    def launch(self):
+        while (
+            len(self.queue) > 0
+            and len(self.pending) < self.qt.conf["spawn_concurrency"]
+        ):
+            shell = self.queue.pop(0)
+            self.pending[shell] = time.monotonic()
+            qt = self.qt.for_shell(shell)
+            spawn_detached(qt.term_command(spawned=self.titled, hidden=True))
+
+    def arrive(self, shell: str, con_id: Optional[int]):
+        with self.cond:
+            start = self.pending.pop(shell, None)
+            if start is None:
+                return
+            self.times[shell] = time.monotonic() - start
+            METRICS.observe(
+                "i3_quickterm_spawn_seconds", self.times[shell], shell=shell
+            )
+            if con_id is not None:
+                self.arrived.append((shell, con_id))
+            self.cond.notify()
+
+    def on_new(self, conn: i3ipc.Connection, e: i3ipc.events.IpcBaseEvent):
+        con = cast(i3ipc.WindowEvent, e).container
+        for shell in list(self.pending):
+            if con.name == term_title(shell):
+                self.arrive(shell, con.id)
+
+    def on_mark(self, conn: i3ipc.Connection, e: i3ipc.events.IpcBaseEvent):
+        shell = shell_from_marks(cast(i3ipc.WindowEvent, e).container.marks)
+        if shell is not None:
+            self.arrive(shell, None)
+
+    def on_tick(self, conn: i3ipc.Connection, e: i3ipc.events.IpcBaseEvent):
+        if cast(i3ipc.TickEvent, e).first:
+            # subscribed: windows can't be missed anymore
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            with self.cond:
+                self.launch()
+                while len(self.arrived) == 0 and len(self.pending) > 0:
+                    self.cond.wait()
+                # windows which appeared during the previous command
+                arrived, self.arrived = self.arrived, []
+                done = len(self.pending) == 0 and len(self.queue) == 0
+
+            if len(arrived) > 0:
+                self.qt.conn.command(
+                    "; ".join(
+                        f"[con_id={con_id}] mark {MARK_QT.format(shell)}, "
+                        "move scratchpad"
+                        for shell, con_id in arrived
+                    )
+                )
+                for shell, con_id in arrived:
+                    self.qt.cache_con(shell, con_id, SCRATCHPAD_WS)
+            if done:
+                break
+        self.qt.conn.main_quit()
+
+    def run(self, timeout: float = SPAWN_TIMEOUT):
+        conn = self.qt.conn
+        conn.on(i3ipc.Event.TICK, self.on_tick)
+        if self.titled:
+            conn.on(i3ipc.Event.WINDOW_NEW, self.on_new)
+            # some terminals set their title after mapping their window
+            conn.on(i3ipc.Event.WINDOW_TITLE, self.on_new)
+        else:
+            conn.on(i3ipc.Event.WINDOW_MARK, self.on_mark)
+        conn.main(timeout=timeout)
+        self.hide_missed()
+
+    def hide_missed(self):
+        """Mark and hide the windows of the terminals still pending, by title
+
+        They are not left visible and unmarked if they appeared unnoticed.
+        """
+        with self.cond:
+            missed = list(self.pending)
+        if not self.titled or len(missed) == 0:
+            return
+        self.qt.conn.command(
+            "; ".join(
+                f'[title="^{re.escape(term_title(shell))}$"] '
+                f"mark {MARK_QT.format(shell)}, move scratchpad"
+                for shell in missed
+            )
+        )
+
+
+def run_spawn(qt: Quickterm, shells: List[str]) -> int:
+    """Start the quickterms of the given shells hidden, report their startup time"""
+    running = set(qt.conn.get_marks())
+    for shell in shells:
+        if MARK_QT.format(shell) in running:
+            print(f"{shell}: already running")
+    shells = [s for s in shells if MARK_QT.format(s) not in running]
+    if len(shells) == 0:
+        return 0
+
+    start = time.monotonic()
+    spawner = Spawner(qt, shells)
+    spawner.run()
+
+    status = 0
+    for shell in shells:
+        if shell in spawner.times:
+            print(f"{shell}: {spawner.times[shell]:.3f}s")
+        else:
+            print(f"{shell}: no window after {SPAWN_TIMEOUT:g}s", file=sys.stderr)
+            status = 1
+    print(f"{len(spawner.times)} shells in {time.monotonic() - start:.3f}s")
+    return status
+
+
+def stats_text(conf: Conf) -> str:
+    """Usage statistics, in the Prometheus text format"""
+    with open_state("prelaunch") as state:
+        hits = state.get("hits", 0)
+        misses = state.get("misses", 0)
+
+    rate = f" ({100 * hits // (hits + misses)}% hit rate)" if hits + misses else ""
+    text = f"# prelaunch: {hits} hits, {misses} misses{rate}\n"
+    text += "# TYPE i3_quickterm_prelaunch_hits_total counter\n"
+    text += f"i3_quickterm_prelaunch_hits_total {hits}\n"
+    text += "# TYPE i3_quickterm_prelaunch_misses_total counter\n"
+    text += f"i3_quickterm_prelaunch_misses_total {misses}\n"
+
+    values: Dict[str, float] = {}
+    path = metrics_path(conf)
+    if path is not None and path.exists():
+        values = StatsFile(path).read()
+    # in host mode, not flushed yet
+    for k, v in METRICS.snapshot().items():
+        values[k] = values.get(k, 0.0) + v
+
+    return text + render_metrics(values)
+
+
+class HostedQuickterm(Quickterm):
+    """Quickterm operated by the host service on behalf of a client"""
+
+    def __init__(
+        self,
+        conf: Conf,
+        shell: Optional[str],
+        conn: i3ipc.Connection,
+        term: Callable[[], Term],
+    ):
+        super().__init__(conf, shell)
+        self._conn = conn
+        self._term = term
+
+    def term_entry(self) -> Term:
+        # detected once for all the sessions, only when a terminal is needed
+        return self._term()
+
+    def execvp(self, cmd):
+        # the service must keep running: start the terminal on the side
+        spawn_detached(cmd, self.conf["_env"])
+
+
+class Session:
+    """Connection and state of one WM instance served by the host"""
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self._conn: Optional[i3ipc.Connection] = None
+
+    @property
+    def conn(self) -> i3ipc.Connection:
+        if self._conn is None:
+            self._conn = i3ipc.Connection(socket_path=self.socket_path)
+        return self._conn
+
+    def close(self):
+        self._conn = None
+
+
+def session_key(env: Mapping[str, str]) -> Optional[Tuple[str, str]]:
+    """Identify the WM instance of a client from its environment"""
+    sock = env.get("SWAYSOCK") or env.get("I3SOCK")
+    if sock is None:
+        return None
+    return sock, env.get("WAYLAND_DISPLAY") or env.get("DISPLAY") or ""
+
+
+def host_socket_path() -> Path:
+    return runtime_dir() / "host.sock"
+
+
+class Host:
+    """Service running quickterm requests for all the sessions of the user
+
+    Configuration and terminal detection are shared between sessions. Each
+    session has its own WM connection, requests of one session are handled in
+    order.
+    """
+
+    def __init__(self, conf: Conf, config: Optional[str]):
+        self.config = config
+        self.sessions: OrderedDict[Tuple[str, str], Session] = OrderedDict()
+        self._lock = threading.Lock()
+        self._term: Optional[Term] = None
+        # replaced as a whole on reload, never modified
+        self._loaded: Tuple[Conf, Optional[List[str]]] = (conf, None)
+
+    @property
+    def conf(self) -> Conf:
+        return self._loaded[0]
+
+    @property
+    def history(self) -> Optional[List[str]]:
+        return self._loaded[1]
+
+    @property
+    def term(self) -> Term:
+        if self._term is None:
+            self._term = select_terminal(self.conf["term"])
+        return self._term
+
+    def reload(self, conf: Conf, history: Optional[List[str]]):
+        if conf["term"] != self.conf["term"]:
+            self._term = None
+        # requests in flight keep the previous pair
+        self._loaded = (conf, history)
+
+    def session(self, key: Tuple[str, str]) -> Session:
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = Session(key[0])
+                self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            session.last_used = time.monotonic()
+
+            while len(self.sessions) > self.conf["host_sessions"]:
+                _, oldest = self.sessions.popitem(last=False)
+                oldest.close()
+
+            return session
+
+    def cleanup(self):
+        """Drop the sessions idle for too long"""
+        now = time.monotonic()
+        with self._lock:
+            for key, session in list(self.sessions.items()):
+                if now - session.last_used > self.conf["host_idle"]:
+                    del self.sessions[key]
+                    session.close()
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        env = request["env"]
+        key = session_key(env)
+        try:
+            args = make_parser().parse_args(request["argv"])
+        except SystemExit:
+            return {"fallback": True}
+
+        if key is None or args.config != self.config:
+            # not ours to serve
+            return {"fallback": True}
+
+        loaded_conf, history = self._loaded
+        conf = dict(loaded_conf)
+        if args.stats:
+            return {"status": 0, "output": stats_text(conf)}
+
+        if args.shell is not None and args.shell not in conf["shells"]:
+            return {"status": 1, "error": f"unknown shell: {args.shell}"}
+
+        conf["_env"] = env
+        if history is not None:
+            conf["_history"] = history
+
+        session = self.session(key)
+        with session.lock:
+            try:
+                run_qt(
+                    HostedQuickterm(conf, args.shell, session.conn, lambda: self.term)
+                )
+            except Exception:
+                # the WM may have been restarted
+                session.close()
+                return {"status": 1, "error": traceback.format_exc()}
+
+        return {"status": 0}
+
+    def _serve_client(self, client: socket.socket):
+        with client, client.makefile("rw") as f:
+            try:
+                request = json.loads(f.readline())
+            except ValueError:
+                return
+            # from now on, the client waits for the reply
+            f.write(json.dumps({"accepted": True}) + "\n")
+            f.flush()
+
+            try:
+                reply = self.handle(request)
+            except Exception:
+                reply = {"status": 1, "error": traceback.format_exc()}
+            f.write(json.dumps(reply) + "\n")
+
+    def serve(self):
+        path = host_socket_path()
+        with suppress(FileNotFoundError):
+            os.unlink(str(path))
+
+        if self.conf["history"] is not None:
+            self._loaded = (self.conf, history_order(self.conf))
+        ConfWatcher(self.config, self.reload).start(self.conf)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(path))
+            server.listen()
+            server.settimeout(60)
+
+            while True:
+                self.cleanup()
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    continue
+                client.settimeout(None)
+                threading.Thread(
+                    target=self._serve_client, args=(client,), daemon=True
+                ).start()
+
+
+def forward_to_host(argv: List[str]) -> Optional[int]:
+    """Let the host service run the request, if there is one
+
+    Returns the exit status, or None if the request has to be run locally
+    (also when the host does not accept it in time)
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(HOST_TIMEOUT)
+        try:
+            client.connect(str(host_socket_path()))
+        except OSError:
+            return None
+
+        with client.makefile("rw") as f:
+            try:
+                f.write(json.dumps({"argv": argv, "env": dict(os.environ)}) + "\n")
+                f.flush()
+                accepted = json.loads(f.readline() or "{}").get("accepted", False)
+            except (OSError, ValueError):
+                return None
+            if not accepted:
+                return None
+
+            # the host runs the request: running it locally would do it twice
+            client.settimeout(None)
+            try:
+                reply = json.loads(f.readline() or "{}")
+            except (OSError, ValueError):
+                reply = {}
+
+    if reply.get("fallback", False):
+        return None
+    if "status" not in reply:
+        print("the host service did not complete the request", file=sys.stderr)
+        return 1
+
+    if "output" in reply:
+        print(reply["output"], end="")
+    if "error" in reply:
+        print(reply["error"], file=sys.stderr)
+    return reply["status"]
+
+
+def load_conf(config: Optional[str]) -> Conf:
+    """Read the configuration, raise ValueError if it can't be used"""
+    conf = copy.deepcopy(DEFAULT_CONF)
+    if config:
+        conf.update(read_conf(config))
+        conf["_config"] = config
+    else:
+        conf.update(read_conf(conf_path()))
+    validate_conf(conf)
+    return conf
+
+
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog="i3-quickterm")
     parser.add_argument("-i", "--in-place", dest="in_place", action="store_true")
+    parser.add_argument("--hidden", dest="hidden", action="store_true")
+    parser.add_argument("--spawned", dest="spawned", action="store_true")
+    parser.add_argument(
+        "--spawn",
+        dest="spawn",
+        metavar="SHELL,...",
+        help="start the quickterms of the given shells hidden, in parallel",
+    )
+    parser.add_argument(
+        "--spawn-all",
+        dest="spawn_all",
+        action="store_true",
+        help="start the quickterms of all the shells hidden, in parallel",
+    )
+    parser.add_argument(
+        "--prelaunch",
+        dest="prelaunch",
+        action="store_true",
+        help="keep the most used shells running hidden",
+    )
+    parser.add_argument(
+        "--stats", dest="stats", action="store_true", help="show usage statistics"
+    )
+    parser.add_argument(
+        "--send",
+        dest="send",
+        metavar="SHELL",
+        help="run the command given after -- in the shell of a quickterm",
+    )
+    parser.add_argument(
+        "--show",
+        dest="show",
+        action="store_true",
+        help="with --send, show the quickterm",
+    )
+    parser.add_argument(
+        "--serve",
+        dest="serve",
+        action="store_true",
+        help="run requests of all the sessions in a single service",
+    )
+    parser.add_argument(
+        "--record",
+        dest="record",
+        metavar="FILE",
+        help="append the messages exchanged with the WM to FILE",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay",
+        metavar="FILE",
+        help="serve a recording as a fake WM on a local socket",
+    )
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true")
     parser.add_argument(
         "-c",
@@ -408,24 +2463,90 @@ def main(argv=None):
     parser.add_argument(
         "--version", action="version", version=f"%(prog)s {__version__}"
     )
-    args = parser.parse_args(argv)
+    return parser
 
-    conf = copy.deepcopy(DEFAULT_CONF)
-    if args.config:
-        conf.update(read_conf(args.config))
-        conf["_config"] = args.config
-    else:
-        conf.update(read_conf(conf_path()))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # command for --send
+    send_cmd = []
+    if "--" in argv:
+        k = argv.index("--")
+        if any(a.startswith("--send") for a in argv[:k]):
+            argv, send_cmd = argv[:k], argv[k + 1 :]
+
+    args = make_parser().parse_args(argv)
+
+    if args.replay is not None:
+        replay = ReplayServer(args.replay)
+        path = runtime_dir() / "replay.sock"
+        replay.listen(path)
+        print(f"I3SOCK={path}", flush=True)
+        replay.serve()
+        return 0
+
+    spawn = args.spawn is not None or args.spawn_all
+    local = args.in_place or args.prelaunch or args.serve or args.send or spawn
+    if not (local or args.record):
+        status = forward_to_host(argv)
+        if status is not None:
+            return status
+
+    try:
+        conf = load_conf(args.config)
+    except ValueError as e:
+        print(f"invalid config file: {e}", file=sys.stderr)
+        return 1
+
+    if args.serve:
+        Host(conf, args.config).serve()
+        return 0
 
     conf["_verbose"] = args.verbose
+    if args.record is not None:
+        conf["_record"] = os.path.abspath(args.record)
+    if args.hidden:
+        conf["_hidden"] = True
+    if args.spawned:
+        conf["_spawned"] = True
+
+    if args.stats:
+        print(stats_text(conf), end="")
+        return 0
+
+    if args.send is not None:
+        if args.send not in conf["shells"]:
+            print(f"unknown shell: {args.send}", file=sys.stderr)
+            return 1
+        if len(send_cmd) == 0:
+            print("no command to send", file=sys.stderr)
+            return 1
+        return run_send(Quickterm(conf, args.send), send_cmd, args.show)
 
     if args.shell is not None and args.shell not in conf["shells"]:
         print(f"unknown shell: {args.shell}", file=sys.stderr)
         return 1
 
+    if spawn:
+        shells = history_order(conf) if args.spawn_all else args.spawn.split(",")
+        unknown = [s for s in shells if s not in conf["shells"]]
+        if len(unknown) > 0:
+            print(f"unknown shell: {', '.join(unknown)}", file=sys.stderr)
+            return 1
+        status = run_spawn(Quickterm(conf, None), shells)
+        flush_metrics(conf)
+        return status
+
     qt = Quickterm(conf, args.shell)
 
+    if args.prelaunch:
+        run_prelaunch(qt)
+        return 0
+
     run_qt(qt, args.in_place)
+    flush_metrics(conf)
 
     return 0
 
@@ -1,4 +1,4 @@
-from i3_quickterm.main import Quickterm, DEFAULT_CONF
+from i3_quickterm.main import CAPABILITIES, Quickterm, DEFAULT_CONF
 
 import i3ipc
 
@@ -42,6 +42,7 @@ def conf_file_factory(tmp_path):
 def i3ipc_workspace():
     ws = unittest.mock.MagicMock()
     ws.name = "ws"
+    ws.focused = True
     ws.rect = i3ipc.Rect({"x": 0, "y": 0, "height": 0, "width": 0})
     return ws
 
@@ -52,15 +53,24 @@ def i3ipc_con(i3ipc_workspace):
     con.find_marked.return_value = [con]
     con.find_focused.return_value = con
     con.id = "0"
+    con.marks = ["quickterm_shell"]
     con.workspace.return_value = i3ipc_workspace
     i3ipc_workspace.find_marked.return_value = [con]
     return con
 
 
 @pytest.fixture
-def i3ipc_connection(i3ipc_con):
+def i3ipc_connection(i3ipc_con, i3ipc_workspace):
     conn = unittest.mock.Mock(i3ipc.Connection)
+    conn.socket_path = "/run/user/1000/i3/ipc-socket"
     conn.get_tree.return_value = i3ipc_con
+    conn.get_marks.return_value = ["quickterm_shell"]
+    conn.get_version.return_value = i3ipc.VersionReply(
+        {"major": 4, "minor": 22, "patch": 0, "human_readable": "4.22"}
+    )
+    CAPABILITIES.clear()
+    conn.get_workspaces.return_value = [i3ipc_workspace]
+    conn.command.return_value = []
     with unittest.mock.patch("i3ipc.Connection") as cm:
         cm.return_value = conn
         yield conn
@@ -73,5 +83,14 @@ def quickterm_mock(i3ipc_connection, conf):
     qt.con = None
     qt.conf = conf
     qt.conn = i3ipc_connection
+    qt.toggle_cached.return_value = None
 
     return qt
+
+
+@pytest.fixture(autouse=True)
+def xdg_runtime_dir(tmp_path, monkeypatch):
+    d = tmp_path / "run"
+    d.mkdir()
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(d))
+    return d
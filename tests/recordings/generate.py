@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""Generate the recordings used by test_replay.py
+
+They are synthetic, not captured from real sessions: this script builds the
+WM state of a few kinds of large sessions and writes the messages that
+`i3-quickterm shell` exchanges with the WM in that state, as `--record`
+would. Run it again when the expected exchanges change.
+"""
+
+import gzip
+import itertools
+import json
+
+from pathlib import Path
+
+
+HERE = Path(__file__).parent
+
+COMMAND = 0
+GET_TREE = 4
+GET_VERSION = 7
+
+I3_VERSION = {
+    "major": 4,
+    "minor": 22,
+    "patch": 0,
+    "human_readable": "4.22 (2023-01-02)",
+    "loaded_config_file_name": "/home/user/.config/i3/config",
+}
+SWAY_VERSION = {
+    "major": 1,
+    "minor": 9,
+    "patch": 0,
+    "human_readable": "1.9",
+    "variant": "sway",
+    "loaded_config_file_name": "/home/user/.config/sway/config",
+}
+
+ids = itertools.count(94000000000000, 16)
+
+
+def rect(x, y, width, height):
+    return {"x": x, "y": y, "width": width, "height": height}
+
+
+def node(type_, name, r, nodes=(), floating_nodes=(), marks=(), layout="splith", **kw):
+    n = {
+        "id": next(ids),
+        "type": type_,
+        "orientation": "horizontal" if layout == "splith" else "none",
+        "scratchpad_state": "none",
+        "percent": None,
+        "urgent": False,
+        "marks": list(marks),
+        "focused": False,
+        "layout": layout,
+        "border": "normal",
+        "current_border_width": 2,
+        "rect": r,
+        "deco_rect": rect(0, 0, 0, 0),
+        "window_rect": rect(0, 0, 0, 0),
+        "geometry": rect(0, 0, 0, 0),
+        "name": name,
+        "window": None,
+        "nodes": list(nodes),
+        "floating_nodes": list(floating_nodes),
+        "focus": [],
+        "fullscreen_mode": 0,
+        "sticky": False,
+        "floating": "auto_off",
+        "swallows": [],
+    }
+    n.update(kw)
+    n["focus"] = [c["id"] for c in n["nodes"] + n["floating_nodes"]]
+    return n
+
+
+def window(name, r, marks=(), focused=False):
+    return node(
+        "con",
+        name,
+        r,
+        marks=marks,
+        focused=focused,
+        window=next(ids) % 100000000,
+        window_properties={"class": "App", "instance": "app", "title": name},
+        window_rect=rect(0, 0, r["width"], r["height"]),
+    )
+
+
+def output(name, r, workspaces):
+    content = node("con", "content", r, nodes=workspaces)
+    return node("output", name, r, nodes=[content])
+
+
+def tree(outputs, scratch=()):
+    r = rect(0, 0, 1920, 1080)
+    floating = [
+        node("floating_con", "", r, nodes=[w], floating="user_on") for w in scratch
+    ]
+    scratch_ws = node("workspace", "__i3_scratch", r, floating_nodes=floating)
+    i3 = output("__i3", r, [scratch_ws])
+    return node("root", "root", r, nodes=[i3, *outputs])
+
+
+def tabbed(depth, leaves, r, prefix, focused=False):
+    """Tabbed containers nested `depth` deep, the deepest one focused"""
+    wins = [window(f"{prefix}-{k}", r) for k in range(leaves)]
+    if focused:
+        wins[-1]["focused"] = True
+    con = node("con", None, r, nodes=wins, layout="tabbed")
+    for k in range(depth):
+        siblings = [window(f"{prefix}-{k}-{j}", r) for j in range(leaves)]
+        layout = "tabbed" if k % 2 else "stacked"
+        con = node("con", None, r, nodes=[*siblings, con], layout=layout)
+    return con
+
+
+def quickterm(r):
+    return window("shell - i3-quickterm", r, marks=["quickterm_shell"])
+
+
+def show_command(ws_rect):
+    # default configuration: full width, quarter height, on top
+    w, h = ws_rect["width"], int(ws_rect["height"] * 0.25)
+    return (
+        "[con_mark=quickterm_shell] move scratchpad, scratchpad show, "
+        f"resize set {w} {h} px, move absolute position {ws_rect['x']} "
+        f"{ws_rect['y']} px"
+    )
+
+
+def exchanges(state, con_id, show=None, version=I3_VERSION):
+    """Messages of `i3-quickterm shell` without cached container"""
+    tree_reply = json.dumps(state)
+    ok = json.dumps([{"success": True}])
+    msgs = [
+        (GET_TREE, "", tree_reply),
+        (COMMAND, f"[con_id={con_id}] floating enable, move scratchpad", ok),
+    ]
+    if show is not None:
+        msgs.append((GET_VERSION, "", json.dumps(version)))
+        msgs.append((COMMAND, show, ok))
+    return [{"type": t, "payload": p, "reply": r, "seconds": 0.0} for t, p, r in msgs]
+
+
+def nested_tabs():
+    """Show from the scratchpad, focus deep in nested tabbed containers"""
+    r = rect(0, 20, 2560, 1420)
+    qt = quickterm(r)
+    wss = [
+        node("workspace", str(k), r, nodes=[tabbed(12, 6, r, f"w{k}", k == 3)])
+        for k in range(1, 9)
+    ]
+    state = tree([output("DP-1", rect(0, 0, 2560, 1440), wss)], scratch=[qt])
+    return exchanges(state, qt["id"], show_command(r))
+
+
+def many_outputs():
+    """Move from a workspace of another output, among 36 outputs"""
+    outputs = []
+    qt = current = None
+    for o in range(36):
+        r = rect(1920 * (o % 6), 1080 * (o // 6), 1920, 1080)
+        ws_rect = dict(r, y=r["y"] + 24, height=1056)
+        wss = []
+        for k in range(4):
+            wins = [window(f"o{o}-w{k}-{j}", ws_rect) for j in range(5)]
+            if o == 20 and k == 0:
+                wins[0]["focused"] = True
+                current = ws_rect
+            if o == 3 and k == 2:
+                qt = quickterm(ws_rect)
+                wins.append(qt)
+            wss.append(node("workspace", f"{o}:{k}", ws_rect, nodes=wins))
+        outputs.append(output(f"OUT-{o}", r, wss))
+    assert qt is not None and current is not None
+    state = tree(outputs)
+    return exchanges(state, qt["id"], show_command(current))
+
+
+def many_marks():
+    """Hide from the current workspace, with thousands of marked windows"""
+    r = rect(0, 0, 3840, 2160)
+    qt = quickterm(r)
+    qt["focused"] = True
+    wss = []
+    for k in range(10):
+        wins = [
+            window(f"w{k}-{j}", r, marks=[f"m{k}-{j}", f"_todo{j % 7}"])
+            for j in range(200)
+        ]
+        if k == 0:
+            wins.append(qt)
+        wss.append(node("workspace", str(k + 1), r, nodes=wins))
+    state = tree([output("HDMI-A-1", r, wss)])
+    return exchanges(state, qt["id"])
+
+
+def sway_outputs():
+    """Show from the scratchpad on sway: sized in % of the workspace"""
+    outputs = []
+    for o in range(8):
+        r = rect(1920 * o, 0, 1920, 1080)
+        wss = []
+        for k in range(6):
+            wins = [window(f"o{o}-w{k}-{j}", r) for j in range(10)]
+            if o == 5 and k == 1:
+                wins[3]["focused"] = True
+            ws = node("workspace", f"{o * 6 + k + 1}", r, nodes=wins)
+            ws["output"] = f"HDMI-A-{o}"
+            wss.append(ws)
+        # no content container on sway
+        outputs.append(node("output", f"HDMI-A-{o}", r, nodes=wss))
+    qt = quickterm(rect(0, 0, 1920, 1080))
+    state = tree(outputs, scratch=[qt])
+    show = (
+        "[con_mark=quickterm_shell] move scratchpad, scratchpad show, "
+        "resize set width 100 ppt height 25 ppt, move position 0 ppt 0 ppt"
+    )
+    return exchanges(state, qt["id"], show, version=SWAY_VERSION)
+
+
+SCENARIOS = {
+    "sway_outputs": sway_outputs,
+    "nested_tabs": nested_tabs,
+    "many_outputs": many_outputs,
+    "many_marks": many_marks,
+}
+
+
+def main():
+    for name, scenario in SCENARIOS.items():
+        header = {"argv": ["shell"], "generated": True, "doc": scenario.__doc__}
+        lines = [json.dumps(header)] + [json.dumps(m) for m in scenario()]
+        data = ("\n".join(lines) + "\n").encode()
+        with open(HERE / f"{name}.jsonl.gz", "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as gz:
+                gz.write(data)
+
+
+if __name__ == "__main__":
+    main()
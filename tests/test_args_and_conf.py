@@ -114,6 +114,34 @@ def test_args_verbose(conf, conf_file_factory, run_qt_patched):
     assert qt.conf["_verbose"]
 
 
+def test_args_stats(conf, conf_file_factory, run_qt_patched, capsys):
+    conf_file_factory.write(conf)
+
+    assert main(["--stats", "-c", f"{conf_file_factory.fname}"]) == 0
+
+    assert run_qt_patched.call_count == 0
+    out, _ = capsys.readouterr()
+    assert out.startswith("# prelaunch: 0 hits, 0 misses")
+
+
+def test_args_send(conf, conf_file_factory, run_qt_patched):
+    conf_file_factory.write(conf)
+
+    with unittest.mock.patch("i3_quickterm.main.run_send") as run_send:
+        run_send.return_value = 0
+        argv = ["-c", f"{conf_file_factory.fname}", "--send", "shell", "--show"]
+        assert main([*argv, "--", "ls", "-l"]) == 0
+
+        run_send.assert_called_once_with(ANY, ["ls", "-l"], True)
+        qt, _, _ = run_send.call_args.args
+        assert qt.shell == "shell"
+
+        # nothing to send
+        assert main(argv) == 1
+
+    assert run_qt_patched.call_count == 0
+
+
 def test_args_wrong_shell(conf, conf_file_factory, run_qt_patched):
     conf_file_factory.write(conf)
 
@@ -122,6 +150,16 @@ def test_args_wrong_shell(conf, conf_file_factory, run_qt_patched):
     assert run_qt_patched.call_count == 0
 
 
+def test_args_invalid_conf(conf, conf_file_factory, run_qt_patched, capsys):
+    conf_file_factory.write({**conf, "pos": "left"})
+
+    assert main(["-c", f"{conf_file_factory.fname}", "shell"]) == 1
+
+    assert run_qt_patched.call_count == 0
+    _, err = capsys.readouterr()
+    assert err.startswith("invalid config file: pos should be")
+
+
 def test_args_system_conf_none(system_conf_none, run_qt_patched, capsys):
     assert main([]) == 0
 
@@ -0,0 +1,149 @@
+from i3_quickterm.main import (
+    Host,
+    HostedQuickterm,
+    forward_to_host,
+    host_socket_path,
+    main,
+)
+
+import socket
+import threading
+import time
+
+import pytest
+import unittest.mock
+
+
+"""Test host mode"""
+
+ENV = {"I3SOCK": "/run/i3.sock", "DISPLAY": ":0"}
+
+
+@pytest.fixture
+def run_qt_patched():
+    with unittest.mock.patch("i3_quickterm.main.run_qt") as mock_qt:
+        yield mock_qt
+
+
+@pytest.fixture
+def host(conf, i3ipc_connection):
+    return Host(conf, None)
+
+
+def test_host_handle(host, run_qt_patched):
+    assert host.handle({"argv": ["shell"], "env": ENV}) == {"status": 0}
+
+    (qt,) = run_qt_patched.call_args.args
+    assert isinstance(qt, HostedQuickterm)
+    assert qt.shell == "shell"
+    assert qt.conf["_env"] == ENV
+    assert qt.term_entry() is host.term
+    assert list(host.sessions) == [("/run/i3.sock", ":0")]
+
+
+def test_host_handle_fallback(host, run_qt_patched):
+    # no WM socket
+    assert host.handle({"argv": [], "env": {"DISPLAY": ":0"}}) == {"fallback": True}
+    # different configuration
+    assert host.handle({"argv": ["-c", "other.json"], "env": ENV}) == {"fallback": True}
+    assert run_qt_patched.call_count == 0
+
+
+def test_host_handle_unknown_shell(host, run_qt_patched):
+    assert host.handle({"argv": ["noshell"], "env": ENV})["status"] == 1
+    assert run_qt_patched.call_count == 0
+
+
+def test_host_sessions_bounded(host, run_qt_patched):
+    host.conf["host_sessions"] = 2
+
+    for k in range(3):
+        host.handle({"argv": [], "env": {"SWAYSOCK": f"/run/sway{k}.sock"}})
+
+    assert list(host.sessions) == [("/run/sway1.sock", ""), ("/run/sway2.sock", "")]
+
+
+def test_host_cleanup(host, run_qt_patched):
+    host.conf["host_idle"] = 10
+
+    host.handle({"argv": [], "env": ENV})
+    with unittest.mock.patch("time.monotonic", return_value=time.monotonic() + 20):
+        host.cleanup()
+
+    assert len(host.sessions) == 0
+
+
+def test_hosted_execvp(host, conf):
+    conf["_env"] = ENV
+    qt = HostedQuickterm(conf, "shell", unittest.mock.Mock(), lambda: host.term)
+
+    with unittest.mock.patch("i3_quickterm.main.spawn_detached") as spawn:
+        qt.execvp(["xterm"])
+
+    spawn.assert_called_once_with(["xterm"], ENV)
+
+
+def test_forward_to_host(host, run_qt_patched, monkeypatch):
+    assert forward_to_host(["shell"]) is None
+
+    threading.Thread(target=host.serve, daemon=True).start()
+    for _ in range(100):
+        monkeypatch.setenv("I3SOCK", "/run/i3.sock")
+        status = forward_to_host(["shell"])
+        if status is not None:
+            break
+        time.sleep(0.01)
+
+    assert status == 0
+    assert run_qt_patched.call_count == 1
+
+    # served by the host, nothing run locally
+    with unittest.mock.patch("i3_quickterm.main.load_conf") as load_conf:
+        assert main(["shell"]) == 0
+    assert load_conf.call_count == 0
+    assert run_qt_patched.call_count == 2
+
+
+def test_host_handle_no_terminal(host, i3ipc_connection):
+    """The terminal is only looked for when needed, failures are reported"""
+    with unittest.mock.patch(
+        "i3_quickterm.main.select_terminal", side_effect=RuntimeError("no terminal")
+    ):
+        tree = i3ipc_connection.get_tree.return_value
+        tree.find_marked.return_value = []
+        reply = host.handle({"argv": ["shell"], "env": ENV})
+        assert reply["status"] == 1
+        assert "no terminal" in reply["error"]
+
+        # toggles don't need the terminal
+        tree.find_marked.return_value = [tree]
+        assert host.handle({"argv": ["shell"], "env": ENV}) == {"status": 0}
+
+
+def test_forward_to_host_slow(host, run_qt_patched, monkeypatch):
+    """Requests accepted by the host are not run locally, however long"""
+    monkeypatch.setattr("i3_quickterm.main.HOST_TIMEOUT", 0.1)
+    monkeypatch.setenv("I3SOCK", "/run/i3.sock")
+    run_qt_patched.side_effect = lambda qt: time.sleep(0.3)
+
+    threading.Thread(target=host.serve, daemon=True).start()
+    for _ in range(100):
+        if host_socket_path().exists():
+            break
+        time.sleep(0.01)
+
+    assert forward_to_host(["shell"]) == 0
+    assert run_qt_patched.call_count == 1
+
+
+def test_forward_to_host_timeout(monkeypatch):
+    """A host not accepting requests does not block them"""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(host_socket_path()))
+    server.listen()
+    monkeypatch.setattr("i3_quickterm.main.HOST_TIMEOUT", 0.1)
+
+    with server:
+        start = time.monotonic()
+        assert forward_to_host(["shell"]) is None
+        assert time.monotonic() - start < 1
@@ -0,0 +1,83 @@
+from i3_quickterm.main import Quickterm
+
+import gc
+import tracemalloc
+
+import i3ipc
+
+
+"""Memory footprint of quickterms kept by long-running processes"""
+
+
+def rect(x=0, y=0, width=1920, height=1080):
+    return {"x": x, "y": y, "width": width, "height": height}
+
+
+def node(con_id, type_="con", name=None, marks=(), nodes=(), focused=False):
+    return {
+        "id": con_id,
+        "type": type_,
+        "name": name,
+        "marks": list(marks),
+        "focused": focused,
+        "rect": rect(),
+        "window_rect": rect(),
+        "deco_rect": rect(),
+        "geometry": rect(),
+        "window_properties": {"class": "Term", "instance": "term", "title": name},
+        "nodes": list(nodes),
+        "floating_nodes": [],
+    }
+
+
+def large_tree(outputs=4, workspaces=10, windows=20):
+    """Tree of a busy session, with the quickterm on the last workspace"""
+    ids = iter(range(1, 1000000))
+    outs = []
+    for o in range(outputs):
+        wss = []
+        for w in range(workspaces):
+            wins = [node(next(ids), name=f"win{k}") for k in range(windows)]
+            wss.append(node(next(ids), "workspace", f"{o}:{w}", nodes=wins))
+        content = node(next(ids), name="content", nodes=wss)
+        outs.append(node(next(ids), "output", f"OUT-{o}", nodes=[content]))
+    wins = wss[-1]["nodes"]
+    wins.append(node(next(ids), name="qt", marks=["quickterm_shell"], focused=True))
+    return node(0, "root", "root", nodes=outs)
+
+
+def allocated(make):
+    """Memory still allocated by what make() returns"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        obj = make()
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return obj, after - before
+
+
+def test_quickterm_footprint(i3ipc_connection, conf):
+    """Quickterms keep a few records, not the tree they were found in"""
+    data = large_tree()
+    i3ipc_connection.get_tree.side_effect = lambda: i3ipc.Con(
+        data, None, i3ipc_connection
+    )
+
+    def quickterm():
+        qt = Quickterm(conf, "shell")
+        assert qt.con is not None and qt.ws is not None
+        return qt
+
+    qt, qt_size = allocated(quickterm)
+    _, tree_size = allocated(lambda: i3ipc_connection.get_tree())
+
+    assert qt.con.workspace == "3:9"
+    assert qt.ws.output == "OUT-3"
+    # includes what the mocked connection records of the calls
+    print(f"quickterm: {qt_size} B, tree: {tree_size} B")
+    assert qt_size < 8192
+    assert qt_size * 100 < tree_size
@@ -0,0 +1,82 @@
+from i3_quickterm.main import METRICS, Metrics, StatsFile, main, render_metrics, run_qt
+
+import pytest
+
+
+"""Test metrics"""
+
+
+@pytest.fixture(autouse=True)
+def metrics_reset():
+    METRICS.values.clear()
+    yield
+    METRICS.values.clear()
+
+
+def test_metrics_histogram():
+    m = Metrics()
+    m.observe("i3_quickterm_request_seconds", 0.02, path="show")
+    m.observe("i3_quickterm_request_seconds", 20, path="show")
+
+    text = render_metrics(m.values)
+    lines = text.splitlines()
+    assert lines[:2] == [
+        "# HELP i3_quickterm_request_seconds "
+        "Duration of the requests per path (hide, show, move, create)",
+        "# TYPE i3_quickterm_request_seconds histogram",
+    ]
+    buckets = [line for line in lines if "_bucket" in line]
+    assert buckets[0] == 'i3_quickterm_request_seconds_bucket{path="show",le="0.005"} 0'
+    assert buckets[2] == 'i3_quickterm_request_seconds_bucket{path="show",le="0.025"} 1'
+    assert buckets[-2] == 'i3_quickterm_request_seconds_bucket{path="show",le="10"} 1'
+    assert buckets[-1] == 'i3_quickterm_request_seconds_bucket{path="show",le="+Inf"} 2'
+    assert 'i3_quickterm_request_seconds_count{path="show"} 2' in lines
+
+
+def test_stats_file(tmp_path):
+    path = tmp_path / "metrics"
+
+    StatsFile(path).add({"a": 1.0, 'b{shell="x"}': 2.0})
+    StatsFile(path).add({"a": 1.0})
+
+    assert StatsFile(path).read() == {"a": 2.0, 'b{shell="x"}': 2.0}
+
+    # not truncated into a different (invalid) series
+    long_series = f'c{{shell="{"x" * 200}"}}'
+    StatsFile(path).add({long_series: 1.0})
+    assert StatsFile(path).read() == {"a": 2.0, 'b{shell="x"}': 2.0}
+
+
+def test_run_qt_metrics(quickterm_mock, i3ipc_con):
+    qt = quickterm_mock
+    qt.shell = "bash"
+    qt.con = i3ipc_con
+    qt.toggle_on_current_ws.return_value = "move"
+
+    run_qt(qt)
+
+    assert METRICS.values['i3_quickterm_toggles_total{shell="bash"}'] == 1
+    assert METRICS.values['i3_quickterm_request_seconds_count{path="move"}'] == 1
+
+    qt.con = None
+    run_qt(qt)
+
+    assert METRICS.values['i3_quickterm_con_misses_total{shell="bash"}'] == 1
+    assert METRICS.values['i3_quickterm_request_seconds_count{path="create"}'] == 1
+
+
+def test_stats_flushed(conf, conf_file_factory, i3ipc_connection, capsys):
+    conf["metrics"] = True
+    conf_file_factory.write(conf)
+
+    for _ in range(2):
+        assert main(["-c", f"{conf_file_factory.fname}", "shell"]) == 0
+    assert len(METRICS.values) == 0
+
+    assert main(["-c", f"{conf_file_factory.fname}", "--stats"]) == 0
+
+    out, _ = capsys.readouterr()
+    assert 'i3_quickterm_toggles_total{shell="shell"} 2\n' in out
+    # the second toggle used the cached container
+    assert 'i3_quickterm_request_seconds_count{path="hide"} 1\n' in out
+    assert 'i3_quickterm_request_seconds_count{path="show"} 1\n' in out
@@ -1,7 +1,28 @@
-from i3_quickterm.main import Quickterm
+from i3_quickterm.main import (
+    CAPABILITIES,
+    TERMS,
+    Quickterm,
+    control_fifo,
+    open_state,
+    prelaunch_missing,
+    relay_pty,
+    run_send,
+    runtime_dir,
+    run_spawn,
+    server_running,
+    stats_text,
+    term_title,
+    wm_key,
+)
 
 import i3ipc
 
+import json
+import os
+import socket
+import threading
+import time
+
 import pytest
 import unittest.mock
 from unittest.mock import call, ANY
@@ -149,3 +170,650 @@ def test_toggle_from_other_workspace(i3ipc_connection, i3ipc_con, conf, execvp):
         ]
     )
     assert execvp.call_count == 0
+
+
+@pytest.fixture
+def shutil_foot_only():
+    def foot_which(p):
+        if p in ("foot", "footclient"):
+            return f"/usr/bin/{p}"
+        return None
+
+    with unittest.mock.patch("shutil.which", wraps=foot_which) as mock_which:
+        yield mock_which
+
+
+@pytest.fixture
+def spawn_detached():
+    with unittest.mock.patch("i3_quickterm.main.spawn_detached") as mock_spawn:
+        # still running
+        mock_spawn.return_value.poll.return_value = None
+        yield mock_spawn
+
+
+def test_execute_term_auto_prefers_client(
+    i3ipc_connection, i3ipc_con, conf, execvp, shutil_foot_only, spawn_detached
+):
+    """Auto-detect picks the client mode and uses the running server"""
+    conf["term"] = "auto"
+
+    qt = Quickterm(conf, "shell")
+
+    with unittest.mock.patch("i3_quickterm.main.server_running", return_value=True):
+        qt.execute_term()
+
+    execvp.assert_has_calls([call("footclient", ANY)])
+    assert spawn_detached.call_count == 0
+
+
+def test_execute_term_client_starts_server(
+    i3ipc_connection, i3ipc_con, conf, execvp, spawn_detached
+):
+    """Server is started on demand"""
+    conf["term"] = "footclient"
+
+    qt = Quickterm(conf, "shell")
+
+    with unittest.mock.patch(
+        "i3_quickterm.main.server_running", side_effect=[False, False, True]
+    ):
+        qt.execute_term()
+
+    spawn_detached.assert_called_once_with(["foot", "--server"], None)
+    execvp.assert_has_calls([call("footclient", ANY)])
+
+
+def test_execute_term_client_fallback(
+    i3ipc_connection, i3ipc_con, conf, execvp, spawn_detached
+):
+    """Standalone terminal is used when the server does not come up"""
+    conf["term"] = "footclient"
+
+    qt = Quickterm(conf, "shell")
+
+    with unittest.mock.patch(
+        "i3_quickterm.main.server_running", return_value=False
+    ), unittest.mock.patch("i3_quickterm.main.TERM_SERVER_TIMEOUT", 0.05):
+        qt.execute_term()
+
+    execvp.assert_has_calls([call("foot", ANY)])
+
+
+def test_server_running_display(tmp_path):
+    """Servers of other displays are not used"""
+    server = TERMS["alacritty-msg"].server
+    assert server is not None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.bind(str(tmp_path / "Alacritty-wayland-2-1234.sock"))
+        s.listen()
+
+        env = {"XDG_RUNTIME_DIR": str(tmp_path), "WAYLAND_DISPLAY": "wayland-1"}
+        assert not server_running(server, env)
+        assert server_running(server, {**env, "WAYLAND_DISPLAY": "wayland-2"})
+
+
+def test_execute_term_server_failed(
+    i3ipc_connection, i3ipc_con, conf, execvp, spawn_detached
+):
+    """A server exiting with an error is not waited for, nor started again"""
+    conf["term"] = "footclient"
+    spawn_detached.return_value.poll.return_value = 1
+
+    start = time.monotonic()
+    with unittest.mock.patch("i3_quickterm.main.server_running", return_value=False):
+        Quickterm(conf, "shell").execute_term()
+        Quickterm(conf, "shell").execute_term()
+
+    assert time.monotonic() - start < 1.0
+    assert spawn_detached.call_count == 1
+    assert [c.args[0] for c in execvp.call_args_list] == ["foot", "foot"]
+
+
+def test_execute_term_server_missing(
+    i3ipc_connection, i3ipc_con, conf, execvp, shutil_foot_only
+):
+    """Auto-detect skips client modes whose server is not installed"""
+    conf["term"] = "auto"
+
+    def which(p):
+        return f"/usr/bin/{p}" if p in ("footclient", "xterm") else None
+
+    shutil_foot_only.side_effect = which
+
+    Quickterm(conf, "shell").execute_term()
+
+    execvp.assert_has_calls([call("xterm", ANY)])
+
+
+def test_launch_inplace_session(i3ipc_connection, conf, execvp):
+    """In place with a session holder: attach or create the session"""
+    conf["shells"] = {"shell": {"cmd": "bash", "session": "tmux"}}
+    qt = Quickterm(conf, "shell")
+    name = f"quickterm_shell-{wm_key(i3ipc_connection)}"
+
+    qt.launch_inplace()
+
+    execvp.assert_called_once_with(
+        "tmux",
+        ["tmux", "-L", "i3-quickterm", "new-session", "-A", "-s", name, "bash"],
+    )
+
+    # each WM instance has its own sessions
+    i3ipc_connection.socket_path = "/run/user/1000/sway-ipc.sock"
+    Quickterm(conf, "shell").launch_inplace()
+    assert execvp.call_args.args[1][6] != name
+
+
+@pytest.fixture
+def hidden_cons(i3ipc_con):
+    scratch = unittest.mock.MagicMock()
+    scratch.name = "__i3_scratch"
+
+    cons = []
+    for k, shell in enumerate(["a", "b", "c"]):
+        c = unittest.mock.Mock(i3ipc.Con)
+        c.id = str(k + 1)
+        c.pid = 100 + k
+        c.marks = [f"quickterm_{shell}"]
+        c.workspace.return_value = scratch
+        cons.append(c)
+
+    i3ipc_con.find_marked.side_effect = lambda m: (
+        cons if m == "quickterm_.*" else [i3ipc_con]
+    )
+    i3ipc_con.leaves.return_value = cons
+    return cons
+
+
+def test_evict_idle(i3ipc_connection, conf, hidden_cons, execvp):
+    """Hidden quickterms idle for too long are closed"""
+    conf["evict_idle"] = 60
+    conf["shells"] = {
+        "a": {"cmd": "bash", "session": "dtach"},
+        "b": {"cmd": "bash", "session": "dtach"},
+        "c": "bash",
+    }
+
+    with unittest.mock.patch("time.time", return_value=1000.0):
+        Quickterm(conf, "a").record_use()
+    with unittest.mock.patch("time.time", return_value=1100.0):
+        qt = Quickterm(conf, "shell")
+        qt.evict_idle()
+
+    # 'c' can't be reattached
+    i3ipc_connection.command.assert_called_once_with("[con_id=1] kill")
+
+    # checked again only after the interval
+    with unittest.mock.patch("time.time", return_value=1110.0):
+        qt.evict_idle(60)
+    with unittest.mock.patch("time.time", return_value=1200.0):
+        qt.evict_idle(60)
+    assert i3ipc_connection.get_tree.call_count == 2
+
+
+def test_evict_rss(i3ipc_connection, conf, hidden_cons, execvp):
+    """Least recently used quickterms are closed to fit the memory budget"""
+    conf["evict_rss"] = 150
+    conf["shells"] = {
+        "a": {"cmd": "bash", "session": "dtach"},
+        "b": {"cmd": "bash", "session": "dtach"},
+        "c": {"cmd": "bash", "session": "dtach"},
+    }
+
+    for t, shell in [(3.0, "a"), (1.0, "b"), (2.0, "c")]:
+        with unittest.mock.patch("time.time", return_value=t):
+            Quickterm(conf, shell).record_use()
+
+    with unittest.mock.patch(
+        "i3_quickterm.main.process_rss", return_value=100 * 1024 * 1024
+    ):
+        Quickterm(conf, "shell").evict_idle()
+
+    i3ipc_connection.command.assert_called_once_with("[con_id=2] kill; [con_id=3] kill")
+
+
+def test_runtime_dir_private():
+    """Directories others can access are not used"""
+    path = runtime_dir()
+
+    path.chmod(0o755)
+    with pytest.raises(RuntimeError):
+        runtime_dir()
+
+    path.chmod(0o700)
+    with unittest.mock.patch("os.getuid", return_value=os.getuid() + 1):
+        with pytest.raises(RuntimeError):
+            runtime_dir()
+
+
+def test_evict_rss_shared(i3ipc_connection, i3ipc_con, conf, hidden_cons, execvp):
+    """Windows of a terminal server count for their share of its memory"""
+    conf["evict_rss"] = 150
+    conf["shells"] = {s: {"cmd": "bash", "session": "dtach"} for s in "abc"}
+    other = unittest.mock.Mock(i3ipc.Con)
+    other.pid = 100
+    for c in hidden_cons:
+        c.pid = 100
+    i3ipc_con.leaves.return_value = [*hidden_cons, other]
+
+    for t, shell in [(3.0, "a"), (1.0, "b"), (2.0, "c")]:
+        with unittest.mock.patch("time.time", return_value=t):
+            Quickterm(conf, shell).record_use()
+
+    with unittest.mock.patch(
+        "i3_quickterm.main.process_rss", return_value=400 * 1024 * 1024
+    ):
+        Quickterm(conf, "shell").evict_idle()
+
+    # 100 MiB each: the last used one fits
+    i3ipc_connection.command.assert_called_once_with("[con_id=2] kill; [con_id=3] kill")
+
+
+def test_launch_inplace_hidden(i3ipc_connection, i3ipc_con, conf, execvp):
+    """Pre-launched: its own window goes to the scratchpad, not the focused one"""
+    conf["_hidden"] = True
+    new = unittest.mock.Mock(i3ipc.Con)
+    new.id = 7
+    new.marks = []
+    i3ipc_con.find_titled.return_value = [i3ipc_con, new]
+    qt = Quickterm(conf, "shell")
+
+    qt.launch_inplace()
+
+    i3ipc_con.find_titled.assert_called_once_with(r"^shell\ \-\ i3\-quickterm$")
+    i3ipc_connection.command.assert_called_once_with(
+        "[con_id=7] mark quickterm_shell, move scratchpad"
+    )
+    execvp.assert_called_once_with("bash", ["bash"])
+
+    # known for the next toggle
+    i3ipc_connection.command.reset_mock()
+    assert qt.toggle_cached() == "show"
+    assert i3ipc_connection.command.call_args.args[0].startswith("[con_id=7 ")
+
+
+def test_launch_inplace_hidden_not_found(i3ipc_connection, i3ipc_con, conf, execvp):
+    """Window not found: nothing is marked"""
+    conf["_hidden"] = True
+    i3ipc_con.find_titled.return_value = []
+
+    with unittest.mock.patch("i3_quickterm.main.OWN_WINDOW_TIMEOUT", 0.05):
+        Quickterm(conf, "shell").launch_inplace()
+
+    assert i3ipc_connection.command.call_count == 0
+    execvp.assert_called_once_with("bash", ["bash"])
+
+
+def test_launch_inplace_spawned(i3ipc_connection, conf, execvp):
+    """Spawned: the spawner takes care of the window"""
+    conf["_spawned"] = True
+    qt = Quickterm(conf, "shell")
+    # marked before this process starts
+    qt.cache_con("shell", 7, "__i3_scratch")
+
+    qt.launch_inplace()
+
+    assert i3ipc_connection.command.call_count == 0
+    execvp.assert_called_once_with("bash", ["bash"])
+    with open_state(qt.cache_name) as cache:
+        assert cache["shell"] == {"id": 7, "ws": "__i3_scratch"}
+
+
+@pytest.fixture
+def fake_wm(i3ipc_connection, spawn_detached):
+    """Emit the window events of the spawned terminals
+
+    Windows of the shells in `fake_wm.titled_late` only get their title after
+    being mapped, the ones of `fake_wm.missed` never show up.
+    """
+    handlers = {}
+    done = threading.Event()
+    i3ipc_connection.titled_late = set()
+    i3ipc_connection.missed = set()
+
+    def on(event, handler):
+        handlers[event] = handler
+
+    def main(timeout):
+        tick = unittest.mock.Mock(i3ipc.TickEvent)
+        tick.first = True
+        handlers[i3ipc.Event.TICK](i3ipc_connection, tick)
+
+        for k in range(3):
+            deadline = time.monotonic() + 5
+            while spawn_detached.call_count <= k and time.monotonic() < deadline:
+                time.sleep(0.001)
+            cmd = spawn_detached.call_args_list[k].args[0]
+            shell = cmd[cmd.index("-i") + 1]
+            if shell in i3ipc_connection.missed:
+                continue
+            e = unittest.mock.Mock()
+            e.container.name = term_title(shell)
+            e.container.id = 10 + k
+            if shell in i3ipc_connection.titled_late:
+                handlers[i3ipc.Event.WINDOW_NEW](i3ipc_connection, unittest.mock.Mock())
+                handlers[i3ipc.Event.WINDOW_TITLE](i3ipc_connection, e)
+            else:
+                handlers[i3ipc.Event.WINDOW_NEW](i3ipc_connection, e)
+
+        if len(i3ipc_connection.missed) == 0:
+            done.wait(5)
+        # else: timeout
+
+    i3ipc_connection.on.side_effect = on
+    i3ipc_connection.main.side_effect = main
+    i3ipc_connection.main_quit.side_effect = done.set
+    i3ipc_connection.get_marks.return_value = ["quickterm_d"]
+    return i3ipc_connection
+
+
+def test_spawn(fake_wm, conf, spawn_detached, capsys):
+    """Spawned in parallel, marked and hidden by batches"""
+    conf["spawn_concurrency"] = 2
+    conf["shells"] = {s: "bash" for s in "abcd"}
+
+    fake_wm.titled_late = {"b"}
+    qt = Quickterm(conf, None)
+    assert run_spawn(qt, ["a", "b", "c", "d"]) == 0
+
+    assert spawn_detached.call_count == 3
+    assert all("--spawned" in c.args[0] for c in spawn_detached.call_args_list)
+    commands = "; ".join(c.args[0] for c in fake_wm.command.call_args_list)
+    for k, shell in enumerate("abc"):
+        assert f"[con_id={10 + k}] mark quickterm_{shell}, move scratchpad" in commands
+    with open_state(qt.cache_name) as cache:
+        assert cache["a"] == {"id": 10, "ws": "__i3_scratch"}
+
+    out = capsys.readouterr().out
+    assert "d: already running\n" in out
+    assert "3 shells in " in out
+
+
+def test_spawn_missed(fake_wm, conf, spawn_detached, capsys):
+    """Windows not seen before the timeout are hidden by title"""
+    conf["shells"] = {s: "bash" for s in "abc"}
+
+    fake_wm.missed = {"b"}
+    assert run_spawn(Quickterm(conf, None), ["a", "b", "c"]) == 1
+
+    fake_wm.command.assert_called_with(
+        r'[title="^b\ \-\ i3\-quickterm$"] mark quickterm_b, move scratchpad'
+    )
+    _, err = capsys.readouterr()
+    assert err == "b: no window after 30s\n"
+
+
+def test_prelaunch_missing(i3ipc_connection, conf, hidden_cons, spawn_detached):
+    """Only the top shells which are not running yet are launched"""
+    conf["prelaunch"] = 2
+    conf["shells"] = {"a": "bash", "d": "bash", "e": "bash"}
+    with open(conf["history"], "w") as f:
+        json.dump(["d", "a", "e"], f)
+
+    prelaunch_missing(Quickterm(conf, None))
+    # launched but not mapped yet: not launched again
+    prelaunch_missing(Quickterm(conf, None))
+
+    spawn_detached.assert_called_once()
+    term_cmd = spawn_detached.call_args.args[0]
+    assert term_cmd[-3:] == ["-i", "d", "--hidden"]
+
+
+def test_prelaunch_skips_evicted(
+    i3ipc_connection, conf, hidden_cons, spawn_detached, execvp
+):
+    """Shells closed by the eviction are not pre-launched again until used"""
+    conf["prelaunch"] = 1
+    conf["evict_idle"] = 60
+    conf["shells"] = {"a": {"cmd": "bash", "session": "dtach"}, "c": "bash"}
+    with open(conf["history"], "w") as f:
+        json.dump(["a", "c"], f)
+
+    with unittest.mock.patch("time.time", return_value=1000.0):
+        Quickterm(conf, "a").record_use()
+    with unittest.mock.patch("time.time", return_value=1100.0):
+        Quickterm(conf, "c").evict_idle()
+    i3ipc_connection.get_tree.return_value.find_marked.side_effect = None
+    i3ipc_connection.get_tree.return_value.find_marked.return_value = []
+
+    prelaunch_missing(Quickterm(conf, None))
+    assert spawn_detached.call_count == 0
+
+    with unittest.mock.patch("time.time", return_value=1200.0):
+        Quickterm(conf, "a").record_use()
+    prelaunch_missing(Quickterm(conf, None))
+    assert spawn_detached.call_count == 1
+
+
+def test_record_prelaunch(i3ipc_connection, conf, spawn_detached):
+    conf["prelaunch"] = 1
+
+    Quickterm(conf, "shell").prelaunch_term()
+    Quickterm(conf, "shell").record_prelaunch(created=False)
+    Quickterm(conf, "shell").record_prelaunch(created=False)
+    Quickterm(conf, "shell").record_prelaunch(created=True)
+
+    text = stats_text(conf)
+    assert text.startswith("# prelaunch: 1 hits, 1 misses (50% hit rate)\n")
+    assert "i3_quickterm_prelaunch_hits_total 1\n" in text
+
+
+def test_execute_term_geometry(
+    i3ipc_connection, i3ipc_con, i3ipc_workspace, conf, execvp
+):
+    """Terminal is started at its final size"""
+    conf["term"] = "foot"
+    conf["class"] = "i3-quickterm"
+    i3ipc_workspace.rect = i3ipc.Rect({"x": 0, "y": 0, "height": 800, "width": 1000})
+
+    i3ipc_con.find_marked.return_value = []
+
+    qt = Quickterm(conf, "shell")
+    assert qt.con is None
+
+    qt.execute_term()
+
+    # the workspace comes from the tree searched for the container
+    assert i3ipc_connection.get_tree.call_count == 1
+    term_cmd = execvp.call_args.args[1]
+    assert term_cmd[:4] == [
+        "foot",
+        "--window-size-pixels=1000x200",
+        "--app-id",
+        "i3-quickterm",
+    ]
+
+
+def test_toggle_cached_hide(i3ipc_connection, conf):
+    """Known container on the current workspace: hide without the tree"""
+    qt = Quickterm(conf, "shell")
+    qt.cache_con("shell", 5, "ws")
+
+    assert qt.toggle_cached() == "hide"
+
+    i3ipc_connection.command.assert_called_once_with(
+        "[con_id=5 con_mark=^quickterm_shell$] floating enable, move scratchpad"
+    )
+    assert i3ipc_connection.get_tree.call_count == 0
+
+    # and show it back
+    i3ipc_connection.command.reset_mock()
+    assert Quickterm(conf, "shell").toggle_cached() == "show"
+    i3ipc_connection.command.assert_called_once_with(
+        "[con_id=5 con_mark=^quickterm_shell$] move scratchpad, scratchpad show, "
+        "resize set 0 0 px, move absolute position 0 0 px"
+    )
+    assert i3ipc_connection.get_tree.call_count == 0
+
+
+def test_toggle_cached_stale(i3ipc_connection, conf):
+    """Commands on a stale container fail: the cache entry is dropped"""
+    qt = Quickterm(conf, "shell")
+    qt.cache_con("shell", 5, "__i3_scratch")
+
+    reply = unittest.mock.Mock(i3ipc.CommandReply)
+    reply.success = False
+    i3ipc_connection.command.return_value = [reply]
+
+    assert qt.toggle_cached() is None
+    assert qt.toggle_cached() is None
+    assert i3ipc_connection.command.call_count == 1
+
+
+def test_toggle_cached_relaunched(i3ipc_connection, conf, execvp):
+    """A new quickterm replaces the cached one, even if its id is reused"""
+    qt = Quickterm(conf, "shell")
+    qt.cache_con("shell", 5, "ws")
+
+    # closed, then launched again: the mark is there but the id is stale
+    Quickterm(conf, "shell").launch_inplace()
+
+    i3ipc_connection.command.reset_mock()
+    assert qt.toggle_cached() is None
+    assert i3ipc_connection.command.call_count == 0
+
+
+def test_toggle_cached_closed(i3ipc_connection, conf):
+    """Quickterm mark is gone: nothing sent"""
+    qt = Quickterm(conf, "shell")
+    qt.cache_con("shell", 5, "ws")
+    i3ipc_connection.get_marks.return_value = []
+
+    assert qt.toggle_cached() is None
+    assert i3ipc_connection.command.call_count == 0
+
+
+@pytest.fixture
+def sway(i3ipc_connection):
+    i3ipc_connection.get_version.return_value = i3ipc.VersionReply(
+        {"major": 1, "minor": 9, "patch": 0, "human_readable": "1.9", "variant": "sway"}
+    )
+    return i3ipc_connection
+
+
+def test_focus_ppt(sway, conf):
+    """Sized in % of the workspace: the tree is not needed"""
+    Quickterm(conf, "shell").focus_on_current_ws()
+
+    sway.command.assert_called_once_with(
+        "[con_mark=quickterm_shell] move scratchpad, scratchpad show, "
+        "resize set width 100 ppt height 25 ppt, move position 0 ppt 0 ppt"
+    )
+    assert sway.get_tree.call_count == 0
+
+    # not exact in %: px
+    conf["width"] = 0.333
+    Quickterm(conf, "shell").focus_on_current_ws()
+    assert sway.command.call_args.args[0].endswith("px")
+
+
+def test_toggle_cached_sway(sway, conf):
+    """Closed quickterms make commands fail on sway: marks are not checked"""
+    qt = Quickterm(conf, "shell")
+    qt.cache_con("shell", 5, "__i3_scratch")
+
+    assert qt.toggle_cached() == "show"
+    assert sway.get_marks.call_count == 0
+
+
+def test_capabilities_cached(sway, conf):
+    """Capabilities are queried once per WM instance"""
+    Quickterm(conf, "shell").focus_on_current_ws()
+    Quickterm(conf, "shell").focus_on_current_ws()
+    # other process
+    CAPABILITIES.clear()
+    Quickterm(conf, "shell").focus_on_current_ws()
+
+    assert sway.get_version.call_count == 1
+
+
+def test_launch_inplace_fifo(i3ipc_connection, conf, execvp):
+    """In place with a control FIFO: relay the shell"""
+    conf["shells"] = {"shell": {"cmd": "bash", "fifo": True}}
+    qt = Quickterm(conf, "shell")
+
+    with unittest.mock.patch(
+        "i3_quickterm.main.relay_pty", return_value=3
+    ) as relay, pytest.raises(SystemExit) as e:
+        qt.launch_inplace()
+
+    assert e.value.code == 3
+    relay.assert_called_once_with(
+        ["bash"], control_fifo("shell", wm_key(i3ipc_connection))
+    )
+    assert execvp.call_count == 0
+
+
+def test_relay_pty(tmp_path, capfd):
+    """Commands written in the FIFO reach the command"""
+    fifo = tmp_path / "qt.fifo"
+
+    def send():
+        for _ in range(100):
+            if fifo.exists():
+                break
+            time.sleep(0.01)
+        with open(fifo, "w") as f:
+            f.write("hello\r")
+
+    t = threading.Thread(target=send)
+    t.start()
+    status = relay_pty(["sh", "-c", "read x; echo got:$x; exit 4"], fifo)
+    t.join()
+
+    assert status == 4
+    out, _ = capfd.readouterr()
+    assert "got:hello" in out
+    assert not fifo.exists()
+
+
+def test_send_session(i3ipc_connection, conf):
+    """Without FIFO, the session holder types the command"""
+    conf["shells"] = {"shell": {"cmd": "bash", "session": "dtach"}}
+    qt = Quickterm(conf, "shell")
+
+    with unittest.mock.patch("subprocess.run") as run:
+        run.return_value.returncode = 0
+        assert qt.send("ls")
+
+    cmd = run.call_args.args[0]
+    assert cmd[:2] == ["dtach", "-p"]
+    assert run.call_args.kwargs["input"] == b"ls\r"
+
+    conf["shells"] = {"shell": {"cmd": "bash", "session": "abduco"}}
+    assert not Quickterm(conf, "shell").send("ls")
+
+
+def test_run_send_start(i3ipc_connection, i3ipc_con, conf, spawn_detached):
+    """Missing quickterm: start it hidden, then send"""
+    conf["shells"] = {"shell": {"cmd": "bash", "fifo": True}}
+    i3ipc_con.find_marked.return_value = []
+    qt = Quickterm(conf, "shell")
+
+    with unittest.mock.patch.object(qt, "send", side_effect=[False, True]) as send:
+        assert run_send(qt, ['print("hi there")']) == 0
+
+    assert spawn_detached.call_args.args[0][-1] == "--hidden"
+    # as written, for the language of the shell
+    send.assert_called_with('print("hi there")')
+
+
+def test_run_send_show(i3ipc_connection, conf):
+    """Shown to send: the next toggle hides it"""
+    conf["shells"] = {"shell": {"cmd": "bash", "fifo": True}}
+    qt = Quickterm(conf, "shell")
+    qt.cache_con("shell", 0, "__i3_scratch")
+
+    with unittest.mock.patch.object(qt, "send", return_value=True):
+        assert run_send(qt, ["ls"], show=True) == 0
+
+    assert Quickterm(conf, "shell").toggle_cached() == "hide"
+
+
+def test_run_send_unsupported(i3ipc_connection, i3ipc_con, conf, spawn_detached):
+    """No way to send to the shell: fail before starting it"""
+    conf["shells"] = {"shell": {"cmd": "bash", "session": "abduco"}}
+    i3ipc_con.find_marked.return_value = []
+
+    assert run_send(Quickterm(conf, "shell"), ["ls"]) == 1
+    assert spawn_detached.call_count == 0
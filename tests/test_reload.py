@@ -0,0 +1,125 @@
+from i3_quickterm.main import (
+    ConfWatcher,
+    FileWatcher,
+    Host,
+    select_shell,
+    validate_conf,
+)
+
+import json
+import queue
+import threading
+
+import pytest
+import unittest.mock
+
+
+"""Test configuration and history reloading"""
+
+
+@pytest.fixture(params=["inotify", "poll"])
+def watcher_mode(request):
+    if request.param == "inotify":
+        yield
+        return
+    with unittest.mock.patch(
+        "i3_quickterm.main.Inotify", side_effect=OSError
+    ), unittest.mock.patch.object(FileWatcher, "POLL_INTERVAL", 0.01):
+        yield
+
+
+def test_file_watcher(tmp_path, watcher_mode):
+    path = tmp_path / "config.json"
+    path.write_text("{}")
+    watcher = FileWatcher([path, tmp_path / "absent"])
+
+    assert watcher.wait(0.05) == set()
+
+    (tmp_path / "other").write_text("x")
+    assert watcher.wait(0.05) == set()
+
+    path.write_text('{"pos": "bottom"}')
+    assert watcher.wait(5) == {path}
+
+    (tmp_path / "absent").write_text("[]")
+    assert watcher.wait(5) == {tmp_path / "absent"}
+    watcher.close()
+
+
+def test_validate_conf(conf):
+    validate_conf(conf)
+
+    for key, value in [
+        ("height", 2),
+        ("pos", "left"),
+        ("shells", {}),
+        ("shells", {"shell": {"fifo": True}}),
+        ("history", 1),
+    ]:
+        with pytest.raises(ValueError):
+            validate_conf({**conf, key: value})
+
+
+def test_conf_watcher(conf, conf_file_factory):
+    conf_file_factory.write(conf)
+    reloads = queue.Queue()  # type: ignore
+
+    watcher = ConfWatcher(
+        str(conf_file_factory.fname), lambda c, h: reloads.put((c, h))
+    )
+    watcher.start(watcher.load())
+
+    conf_file_factory.write({**conf, "height": 2})
+    # invalid: kept out
+    with pytest.raises(queue.Empty):
+        reloads.get(timeout=0.2)
+
+    conf_file_factory.write({**conf, "shells": {"shell": "bash", "other": "zsh"}})
+    new_conf, history = reloads.get(timeout=5)
+    assert list(new_conf["shells"]) == ["shell", "other"]
+    assert sorted(history) == ["other", "shell"]
+
+    with open(conf["history"], "w") as f:
+        json.dump(["shell", "other"], f)
+    new_conf, history = reloads.get(timeout=5)
+    assert history == ["shell", "other"]
+
+
+def test_select_shell_cached_history(conf):
+    conf["shells"] = {"shell": "bash", "other": "zsh"}
+    conf["_history"] = ["other", "shell"]
+
+    with unittest.mock.patch("subprocess.Popen") as popen:
+        popen.return_value.communicate.return_value = (b"shell\n", b"")
+        assert select_shell(conf) == "shell"
+
+    written = [c.args[0] for c in popen.return_value.stdin.write.call_args_list]
+    assert written == [b"other\n", b"shell\n"]
+    with open(conf["history"]) as f:
+        assert json.load(f) == ["shell", "other"]
+
+
+def test_host_reload(conf, i3ipc_connection):
+    host = Host(conf, None)
+    term = host.term
+
+    host.reload({**conf, "term": "urxvt"}, ["shell"])
+    assert host.term is not term
+    assert host.history == ["shell"]
+
+    with unittest.mock.patch("i3_quickterm.main.run_qt") as run_qt:
+        env = {"I3SOCK": "/run/i3.sock"}
+        assert host.handle({"argv": [], "env": env}) == {"status": 0}
+    (qt,) = run_qt.call_args.args
+    assert qt.conf["_history"] == ["shell"]
+    assert qt.conf["term"] == "urxvt"
+
+
+def test_conf_watcher_thread_is_daemon(conf, conf_file_factory):
+    conf_file_factory.write(conf)
+    watcher = ConfWatcher(str(conf_file_factory.fname), lambda c, h: None)
+
+    before = set(threading.enumerate())
+    watcher.start(watcher.load())
+    (thread,) = set(threading.enumerate()) - before
+    assert thread.daemon
@@ -0,0 +1,69 @@
+from i3_quickterm.main import ReplayServer, main, read_recording
+
+import json
+import threading
+import time
+
+import pytest
+
+from pathlib import Path
+
+
+"""Replay recorded sessions (see recordings/generate.py)"""
+
+RECORDINGS = sorted((Path(__file__).parent / "recordings").glob("*.jsonl.gz"))
+
+
+@pytest.fixture
+def config(conf, conf_file_factory):
+    conf_file_factory.write({"shells": conf["shells"], "history": None})
+    return str(conf_file_factory.fname)
+
+
+def replay(path, tmp_path, monkeypatch):
+    server = ReplayServer(str(path))
+    sock = tmp_path / "wm.sock"
+    server.listen(sock)
+    threading.Thread(target=server.serve, daemon=True).start()
+    monkeypatch.setenv("I3SOCK", str(sock))
+    return server
+
+
+@pytest.mark.parametrize("path", RECORDINGS, ids=lambda p: p.name.split(".")[0])
+def test_replay(path, config, tmp_path, monkeypatch):
+    server = replay(path, tmp_path, monkeypatch)
+
+    start = time.monotonic()
+    assert main(["-c", config, "shell"]) == 0
+    print(f"{path.name}: {time.monotonic() - start:.3f}s")
+
+    assert server.unmatched == []
+    assert server.done
+
+
+def test_replay_unmatched(config, tmp_path, monkeypatch):
+    """Requests which are not in the recording are reported"""
+    server = replay(RECORDINGS[0], tmp_path, monkeypatch)
+
+    assert main(["-c", config, "shell"]) == 0
+    # the container is cached now: the workspaces are queried instead
+    assert main(["-c", config, "shell"]) == 0
+
+    assert (1, "") in server.unmatched
+
+
+def test_record(config, tmp_path, monkeypatch):
+    path = RECORDINGS[0]
+    replay(path, tmp_path, monkeypatch)
+    out = tmp_path / "recording.jsonl"
+
+    assert main(["-c", config, "--record", str(out), "shell"]) == 0
+
+    with open(out) as f:
+        assert json.loads(f.readline())["argv"] is not None
+    recorded = read_recording(str(out))
+    expected = read_recording(str(path))
+    assert [(m["type"], m["payload"]) for m in recorded] == [
+        (m["type"], m["payload"]) for m in expected
+    ]
+    assert all(m["seconds"] >= 0 for m in recorded)
@@ -52,6 +52,7 @@ def test_run_qt_execute_shell(quickterm_mock):
     qt = quickterm_mock
     qt.shell = "bash"
     run_qt(qt)
+    qt.record_prelaunch.assert_called_once_with(created=True)
     qt.execute_term.assert_called_once()
 
 
@@ -60,4 +61,5 @@ def test_run_qt_toggle_on_current_ws(i3ipc_con, quickterm_mock):
     qt.shell = "bash"
     qt.con = i3ipc_con
     run_qt(qt)
+    qt.record_prelaunch.assert_called_once_with(created=False)
     qt.toggle_on_current_ws.assert_called_once()
@@ -12,6 +12,7 @@ class Connection:
     def socket_path(self) -> str: ...
     @property
     def auto_reconnect(self) -> bool: ...
+    def _message(self, message_type: MessageType, payload: str) -> str: ...
     def command(self, payload: str) -> List[CommandReply]: ...
     def get_version(self) -> VersionReply: ...
     def get_bar_config(self, bar_id: Optional[str] = None) -> Optional[BarConfigReply]: ...
@@ -5,8 +5,19 @@ class _BaseReply:
     ipc_data: Incomplete
     def __init__(self, data) -> None: ...
 
-class CommandReply(_BaseReply): ...
-class WorkspaceReply(_BaseReply): ...
+class CommandReply(_BaseReply):
+    success: bool
+    error: Incomplete
+
+class WorkspaceReply(_BaseReply):
+    num: int
+    name: str
+    visible: bool
+    focused: bool
+    urgent: bool
+    rect: Rect
+    output: str
+
 class OutputReply(_BaseReply): ...
 
 class BarConfigGaps: